@@ -0,0 +1,121 @@
+import io
+import re
+import struct
+
+from . import logging_utils
+
+try:
+    from PIL import Image
+except ImportError:  # Optional dependency (pip install muzlib[cover])
+    Image = None
+
+
+_SIZE_PATTERN = re.compile(r'=w\d+-h\d+')
+
+
+def select_thumbnail(thumbnails, max_size=None):
+    """
+    Choose the thumbnail to embed.
+
+    Args:
+        thumbnails (list[dict]): YTM thumbnails with `url`, `width` and `height`, smallest first.
+        max_size (int, optional): Maximum width/height of the cover in pixels.
+
+    Returns:
+        str: URL of the smallest thumbnail that is at least `max_size` pixels large, or of the
+            largest one if none is. The largest thumbnail is used when `max_size` is not set.
+    """
+    if not max_size: return thumbnails[-1]['url']
+
+    for thumbnail in sorted(thumbnails, key=lambda t: t.get('width', 0)):
+        if min(thumbnail.get('width', 0), thumbnail.get('height', 0)) >= max_size:
+            url = thumbnail['url']
+            break
+    else:
+        url = thumbnails[-1]['url']
+
+    # Google image URLs scale on the server side, ask for the exact size
+    if _SIZE_PATTERN.search(url):
+        url = _SIZE_PATTERN.sub(f'=w{max_size}-h{max_size}', url)
+    return url
+
+
+def image_info(data):
+    """
+    Read the mime type and dimensions of JPEG, PNG and WebP images from their header.
+
+    Returns:
+        tuple: (mime, width, height), dimensions are 0 if they are unknown.
+    """
+    if data.startswith(b'\x89PNG\r\n\x1a\n') and len(data) >= 24:
+        width, height = struct.unpack('>II', data[16:24])
+        return 'image/png', width, height
+
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        chunk = data[12:16]
+        if chunk == b'VP8X' and len(data) >= 30:
+            width = int.from_bytes(data[24:27], 'little') + 1
+            height = int.from_bytes(data[27:30], 'little') + 1
+            return 'image/webp', width, height
+        if chunk == b'VP8 ' and len(data) >= 30:
+            width, height = struct.unpack('<HH', data[26:30])
+            return 'image/webp', width & 0x3fff, height & 0x3fff
+        if chunk == b'VP8L' and len(data) >= 25:
+            bits = int.from_bytes(data[21:25], 'little')
+            return 'image/webp', (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+        return 'image/webp', 0, 0
+
+    if data[:2] == b'\xff\xd8':
+        i = 2
+        while i + 9 < len(data):
+            if data[i] != 0xff:
+                i += 1
+                continue
+            marker = data[i + 1]
+            # Start of frame markers carry the dimensions
+            if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                height, width = struct.unpack('>HH', data[i + 5:i + 9])
+                return 'image/jpeg', width, height
+            if marker in (0xd8, 0x01) or 0xd0 <= marker <= 0xd7:
+                i += 2
+                continue
+            i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+        return 'image/jpeg', 0, 0
+
+    return 'image/jpeg', 0, 0
+
+
+def normalize_cover(data, max_size=None, quality=90):
+    """
+    Downscale and recompress a cover that is larger than `max_size`.
+
+    Resizing needs Pillow; without it the cover is returned unchanged.
+
+    Args:
+        data (bytes): Image data.
+        max_size (int, optional): Maximum width/height in pixels, None keeps the original.
+        quality (int): JPEG quality used when the cover is recompressed.
+
+    Returns:
+        tuple: (data, mime, width, height) of the cover to embed.
+    """
+    mime, width, height = image_info(data)
+
+    if not max_size or (width and max(width, height) <= max_size):
+        return data, mime, width, height
+
+    if Image is None:
+        logging_utils.logging.warning("Cover: Pillow is not installed, embedding oversized cover as is")
+        return data, mime, width, height
+
+    with Image.open(io.BytesIO(data)) as image:
+        if max(image.size) <= max_size:
+            return data, mime, *image.size
+
+        image = image.convert('RGB')
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=quality, optimize=True)
+        width, height = image.size
+
+    return output.getvalue(), 'image/jpeg', width, height
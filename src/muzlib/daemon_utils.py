@@ -0,0 +1,269 @@
+import os
+import json
+import time
+import queue
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from . import logging_utils
+from . import queue_utils
+
+
+# Minimum seconds between retry checks while failed tracks are due (a retry job may still be running)
+RETRY_POLL_INTERVAL = 30
+
+
+class MuzlibDaemon():
+    def __init__(self, muzlib, host="127.0.0.1", port=8765, sync_interval=24 * 60 * 60):
+        """
+        Long-running muzlib service.
+
+        One `Muzlib` instance (YouTube clients, yt-dlp instances, caches, database) stays loaded,
+        jobs arrive over a local HTTP endpoint and the artists of the watch list are resynced
+        periodically.
+
+        :param muzlib: Muzlib instance of the library
+        :param host: address to listen on (localhost only by default)
+        :param port: port to listen on
+        :param sync_interval: seconds between resyncs of the watch list, failed tracks are retried as soon as they are due
+        """
+        self.muzlib = muzlib
+        self.sync_interval = sync_interval
+        self.watchlist_path = os.path.join(muzlib.info_path, "watchlist.json")
+
+        self.jobs = queue.Queue()
+        self.started = time.time()
+        self.running_job = None
+        self.completed = 0
+        self.failed = 0
+        self.last_sync = None
+        self._retry_queued = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sync_now = threading.Event()
+
+        self.server = ThreadingHTTPServer((host, port), _make_handler(self))
+
+    # Watch list
+
+    def load_watchlist(self):
+        if not os.path.isfile(self.watchlist_path): return []
+        with open(self.watchlist_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def add_to_watchlist(self, browse_id, name=""):
+        """
+        Add an artist to the watch list.
+
+        :return: False if the artist is already watched
+        """
+        with self._lock:
+            watchlist = self.load_watchlist()
+            if any(artist['browse_id'] == browse_id for artist in watchlist): return False
+
+            watchlist.append({'browse_id': browse_id, 'name': name})
+            tmp_path = self.watchlist_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump(watchlist, file, indent=4, ensure_ascii=False)
+            os.replace(tmp_path, self.watchlist_path)
+            return True
+
+    def sync(self):
+        """
+        Queue a resync of every watched artist (only new tracks are downloaded) and retry failed tracks.
+        """
+        for artist in self.load_watchlist():
+            self.submit(queue_utils.JobKind.ARTIST.value, {'browse_id': artist['browse_id']})
+        self.submit("retry", {})
+        self.last_sync = time.time()
+
+    # Jobs
+
+    def submit(self, kind, payload):
+        """
+        Queue a job.
+
+        :param kind: artist, album, track, restore or retry
+        :param payload: job payload as in `Muzlib.run_job()`, or {"query": ...} to download the top search
+            result, or {"backup_path": ...} for restore jobs
+        :return: number of jobs waiting in the queue
+        """
+        if kind == "retry":
+            # One retry job handles every due track
+            with self._lock:
+                if self._retry_queued: return self.jobs.qsize()
+                self._retry_queued = True
+        else:
+            queue_utils.JobKind(kind)
+        self.jobs.put((kind, payload))
+        return self.jobs.qsize()
+
+    def _run_job(self, kind, payload):
+        from .muzlib import SearchType
+
+        ml = self.muzlib
+
+        if kind == "retry":
+            try:
+                ml.retry_failed()
+            finally:
+                with self._lock:
+                    self._retry_queued = False
+        elif 'query' in payload:
+            search_type = SearchType(kind)
+            search_results = ml.search(payload['query'], search_type)
+            if not search_results:
+                raise ValueError(f"Nothing found for {payload['query']}")
+            ml.download_by_search_result(search_results[0], search_type)
+        elif kind == queue_utils.JobKind.ARTIST.value:
+            ml._get_discography_by_artist_id(payload['browse_id'])
+        elif kind == queue_utils.JobKind.RESTORE.value and 'backup_path' in payload:
+            ml.restore_library(payload['backup_path'])
+        else:
+            ml.run_job(kind, payload)
+
+    def _job_loop(self):
+        while not self._stop.is_set():
+            try:
+                kind, payload = self.jobs.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            self.running_job = {'kind': kind, 'payload': payload, 'started': time.time()}
+            try:
+                self._run_job(kind, payload)
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                logging_utils.logging.error(f"Daemon: {kind} job {payload} failed: {e}")
+            finally:
+                self.running_job = None
+                self.jobs.task_done()
+
+    def _sync_loop(self):
+        next_sync = time.time()
+        while not self._stop.is_set():
+            wake = next_sync
+            try:
+                if time.time() >= next_sync:
+                    next_sync = time.time() + self.sync_interval
+                    self.sync()
+                elif self.muzlib.failures.due():
+                    self.submit("retry", {})
+
+                # Wake up when the backoff of the next failed track expires, not only at the next resync
+                next_retry = self.muzlib.failures.next_retry()
+                if next_retry is not None:
+                    wake = min(next_sync, next_retry if next_retry > time.time() else time.time() + RETRY_POLL_INTERVAL)
+            except Exception as e:
+                logging_utils.logging.error(f"Daemon: sync failed: {e}")
+
+            if self._sync_now.wait(max(wake - time.time(), 0)):
+                self._sync_now.clear()
+                next_sync = time.time()
+
+    def sync_now(self):
+        self._sync_now.set()
+
+    # Stats
+
+    def stats(self):
+        downloads = list(self.muzlib.download_stats)
+        return {
+            'status': 'ok',
+            'uptime': time.time() - self.started,
+            'queue_depth': self.jobs.qsize(),
+            'running_job': self.running_job,
+            'completed_jobs': self.completed,
+            'failed_jobs': self.failed,
+            'failed_tracks': len(self.muzlib.failures.pending()),
+            'tracks_in_db': len(self.muzlib.db),
+            'recent_downloads': len(downloads),
+            'average_bytes_per_second': sum(d['bytes_per_second'] for d in downloads) / len(downloads) if downloads else 0,
+            'watched_artists': len(self.load_watchlist()),
+            'last_sync': self.last_sync,
+        }
+
+    # Lifecycle
+
+    def serve_forever(self):
+        """
+        Start the job and sync threads and serve HTTP requests until `shutdown()` is called.
+        """
+        threading.Thread(target=self._job_loop, name="muzlib-jobs", daemon=True).start()
+        threading.Thread(target=self._sync_loop, name="muzlib-sync", daemon=True).start()
+
+        host, port = self.server.server_address[:2]
+        logging_utils.logging.info(f"Daemon: listening on http://{host}:{port}")
+        print(f"Muzlib daemon listening on http://{host}:{port}")
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+
+    def shutdown(self):
+        self._stop.set()
+        self._sync_now.set()
+        self.server.shutdown()
+
+
+def _make_handler(daemon):
+    class Handler(BaseHTTPRequestHandler):
+        """
+        GET  /health     -> {"status": "ok", "uptime": ...}
+        GET  /stats      -> queue depth, running job, counters
+        GET  /watchlist  -> watched artists
+        POST /jobs       {"kind": "artist|album|track|restore", ...payload}
+        POST /watchlist  {"browse_id": ..., "name": ...} or {"query": ...}
+        POST /sync       resync the watch list now
+        """
+
+        def _send(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send(200, {'status': 'ok', 'uptime': time.time() - daemon.started})
+            elif self.path == "/stats":
+                self._send(200, daemon.stats())
+            elif self.path == "/watchlist":
+                self._send(200, daemon.load_watchlist())
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_POST(self):
+            try:
+                body = self._read_json()
+                if self.path == "/jobs":
+                    kind = body.pop('kind', '')
+                    self._send(202, {'queued': True, 'queue_depth': daemon.submit(kind, body)})
+                elif self.path == "/watchlist":
+                    browse_id, name = body.get('browse_id', ''), body.get('name', '')
+                    if not browse_id and body.get('query'):
+                        results = daemon.muzlib.search_artist(body['query'])
+                        if not results:
+                            self._send(404, {'error': f"artist {body['query']} not found"})
+                            return
+                        browse_id, name = results[0]['browseId'], results[0]['artist']
+                    self._send(200, {'added': daemon.add_to_watchlist(browse_id, name), 'browse_id': browse_id, 'name': name})
+                elif self.path == "/sync":
+                    daemon.sync_now()
+                    self._send(202, {'syncing': True})
+                else:
+                    self._send(404, {'error': 'not found'})
+            except (ValueError, KeyError) as e:
+                self._send(400, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            logging_utils.logging.debug(f"Daemon: {self.address_string()} {format % args}")
+
+    return Handler
@@ -0,0 +1,287 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from enum import Enum
+
+from . import logging_utils
+from .queue_utils import FileLock
+
+
+class FailureClass(str, Enum):
+    TRANSIENT = "transient"
+    THROTTLED = "throttled"
+    PERMANENT = "permanent"
+
+
+# Backoff parameters per failure class: (first delay, maximum delay) in seconds
+BACKOFF = {
+    FailureClass.TRANSIENT: (60, 6 * 60 * 60),
+    FailureClass.THROTTLED: (15 * 60, 24 * 60 * 60),
+    FailureClass.PERMANENT: (24 * 60 * 60, 30 * 24 * 60 * 60),
+}
+
+_THROTTLED_PATTERNS = (
+    "http error 429",
+    "too many requests",
+    "rate limit",
+    "rate-limit",
+    "sign in to confirm you're not a bot",
+    "sign in to confirm you’re not a bot",
+)
+
+_PERMANENT_PATTERNS = (
+    "video unavailable",
+    "private video",
+    "this video is not available",
+    "this video has been removed",
+    "account associated with this video has been terminated",
+    "copyright claim",
+    "members-only",
+    "join this channel to get access",
+    "not made this video available in your country",
+    "http error 404",
+    "http error 410",
+)
+
+
+def classify_error(error):
+    """
+    Classify a download error by how it should be retried.
+
+    Args:
+        error (BaseException | str): The exception raised while downloading (or its message).
+
+    Returns:
+        FailureClass: `THROTTLED` for rate limiting, `PERMANENT` for errors that will not go away
+            by themselves (removed or private videos), `TRANSIENT` for everything else.
+    """
+    message = str(error).lower()
+
+    if any(pattern in message for pattern in _THROTTLED_PATTERNS):
+        return FailureClass.THROTTLED
+    if any(pattern in message for pattern in _PERMANENT_PATTERNS):
+        return FailureClass.PERMANENT
+
+    # Network problems, timeouts, FFmpeg hiccups and unknown errors are worth retrying soon
+    return FailureClass.TRANSIENT
+
+
+def backoff_delay(failure_class, attempts):
+    """
+    Exponential backoff delay (in seconds) after `attempts` failed attempts of the given class.
+    """
+    first_delay, max_delay = BACKOFF[FailureClass(failure_class)]
+    return min(first_delay * 2 ** max(attempts - 1, 0), max_delay)
+
+
+class FailureJournal():
+    def __init__(self, journal_path):
+        """
+        Append-only journal of failed downloads.
+
+        Every failure and every recovery is appended as one JSON line, so a crash can never
+        lose or corrupt entries that were already written. The latest line per `ytm_id` wins.
+        Covers are stored once per album next to the journal, entries only reference them.
+
+        :param journal_path: path to the journal file (JSON lines)
+        """
+        self.journal_path = journal_path
+        self.covers_path = os.path.splitext(journal_path)[0] + "_covers"
+        self._lock = threading.Lock()
+        # Workers in other processes (or on other hosts) share the journal
+        self._file_lock = FileLock(journal_path + ".lock")
+
+        # ytm_id -> latest failure entry (resolved entries are dropped)
+        self._pending = {}
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.journal_path): return
+
+        with open(self.journal_path, "r", encoding="utf-8") as file:
+            for line in file:
+                line = line.strip()
+                if not line: continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn last line after a crash, ignore it
+                    logging_utils.logging.warning(f"Failure journal: skipping malformed line in {self.journal_path}")
+                    continue
+                self._apply(entry)
+
+    def _apply(self, entry):
+        ytm_id = entry.get('ytm_id', '')
+        if not ytm_id: return
+
+        if entry.get('status') == 'resolved':
+            self._pending.pop(ytm_id, None)
+        else:
+            self._pending[ytm_id] = entry
+
+    def _append(self, entry):
+        with self._file_lock:
+            with open(self.journal_path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+        self._apply(entry)
+
+    def _store_cover(self, track_info):
+        # Replace the base64 cover of a track dictionary by a reference to a file with it
+        if not track_info.get('cover'): return track_info
+
+        cover = track_info['cover']
+        cover_ref = hashlib.sha1(cover.encode('ascii')).hexdigest()
+        cover_path = os.path.join(self.covers_path, cover_ref)
+        if not os.path.exists(cover_path):
+            os.makedirs(self.covers_path, exist_ok=True)
+            tmp_path = f"{cover_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="ascii") as file:
+                file.write(cover)
+            os.replace(tmp_path, cover_path)
+
+        track_info = {key: value for key, value in track_info.items() if key != 'cover'}
+        track_info['cover_ref'] = cover_ref
+        return track_info
+
+    def track_info(self, entry):
+        """
+        Returns:
+            dict: Track dictionary of a journal entry with its cover loaded, for retrying it.
+        """
+        track_info = dict(entry['track_info'])
+        cover_ref = track_info.pop('cover_ref', '')
+        if cover_ref:
+            try:
+                with open(os.path.join(self.covers_path, cover_ref), "r", encoding="ascii") as file:
+                    track_info['cover'] = file.read()
+            except FileNotFoundError:
+                track_info['cover'] = ''
+        return track_info
+
+    def record_failure(self, track_info, error):
+        """
+        Append a failure of `track_info` to the journal and schedule its next retry.
+
+        Returns:
+            dict: The journal entry that was written.
+        """
+        ytm_id = track_info.get('ytm_id', '')
+        track_info = self._store_cover(track_info)
+        failure_class = classify_error(error)
+
+        with self._lock:
+            previous = self._pending.get(ytm_id)
+            attempts = previous['attempts'] + 1 if previous else 1
+            now = time.time()
+
+            entry = {
+                'ytm_id': ytm_id,
+                'status': 'failed',
+                'class': failure_class.value,
+                'error': str(error),
+                'attempts': attempts,
+                'time': now,
+                'next_retry': now + backoff_delay(failure_class, attempts),
+                'track_info': track_info,
+            }
+            self._append(entry)
+
+        return entry
+
+    def record_success(self, ytm_id):
+        """
+        Mark a previously failed track as recovered. Does nothing for tracks that never failed.
+        """
+        with self._lock:
+            if ytm_id not in self._pending: return
+            self._append({'ytm_id': ytm_id, 'status': 'resolved', 'time': time.time()})
+
+    def pending(self):
+        """
+        Returns:
+            list[dict]: Latest entry of every track that is still failing.
+        """
+        with self._lock:
+            return list(self._pending.values())
+
+    def due(self, now=None, include_permanent=False):
+        """
+        Returns:
+            list[dict]: Failing entries whose backoff has expired. Permanent failures are only
+                returned when `include_permanent` is set.
+        """
+        now = time.time() if now is None else now
+        return [
+            entry for entry in self.pending()
+            if entry['next_retry'] <= now
+            and (include_permanent or entry['class'] != FailureClass.PERMANENT.value)
+        ]
+
+    def next_retry(self, include_permanent=False):
+        """
+        Returns:
+            float | None: Earliest time a failing track is due, None if nothing is failing.
+        """
+        times = [
+            entry['next_retry'] for entry in self.pending()
+            if include_permanent or entry['class'] != FailureClass.PERMANENT.value
+        ]
+        return min(times) if times else None
+
+    def compact(self):
+        """
+        Rewrite the journal so that it only contains the latest entry of still failing tracks.
+
+        The journal is re-read first, so entries appended by other processes are kept. Covers
+        no entry refers to anymore are removed.
+        """
+        with self._lock, self._file_lock:
+            self._pending = {}
+            self._load()
+
+            # Entries of older versions carry the cover inline
+            for entry in self._pending.values():
+                entry['track_info'] = self._store_cover(entry['track_info'])
+
+            tmp_path = self.journal_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                for entry in self._pending.values():
+                    file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.journal_path)
+
+            referenced = {entry['track_info'].get('cover_ref') for entry in self._pending.values()}
+            if os.path.isdir(self.covers_path):
+                for cover_ref in os.listdir(self.covers_path):
+                    cover_path = os.path.join(self.covers_path, cover_ref)
+                    # Recent covers may belong to failures other processes are just writing
+                    if cover_ref not in referenced and time.time() - os.path.getmtime(cover_path) > 60 * 60:
+                        os.remove(cover_path)
+
+    def import_legacy(self, missing_path):
+        """
+        Move entries of the old `missing.json` list into the journal and remove the old file.
+        """
+        if not os.path.isfile(missing_path): return
+
+        try:
+            with open(missing_path, "r", encoding="utf-8") as file:
+                missing_track_metadata = json.load(file)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            # Older versions could leave the file half-written, keep it for manual recovery
+            corrupt_path = missing_path + ".corrupt"
+            os.replace(missing_path, corrupt_path)
+            logging_utils.logging.error(f"Failure journal: can't import {missing_path} ({e}), moved it to {corrupt_path}")
+            return
+
+        for track_info in missing_track_metadata:
+            if track_info.get('ytm_id', '') in self._pending: continue
+            self.record_failure(track_info, "imported from missing.json")
+
+        os.remove(missing_path)
+        logging_utils.logging.info(f"Failure journal: imported {len(missing_track_metadata)} entries from {missing_path}")
@@ -0,0 +1,262 @@
+import os
+import time
+import sqlite3
+from pathlib import Path
+
+from . import logging_utils
+from .tag_utils import tag_utils
+
+
+AUDIO_EXTENSIONS = {'.mp3', '.opus'}
+INFO_DIR = '.muzlib'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    ytm_id TEXT,
+    track_name TEXT,
+    track_artists TEXT,
+    album_name TEXT COLLATE NOCASE,
+    album_artists TEXT,
+    release_date TEXT,
+    track_number INTEGER,
+    total_tracks INTEGER,
+    has_lyrics INTEGER NOT NULL DEFAULT 0,
+    mtime REAL,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS tracks_ytm_id ON tracks (ytm_id);
+CREATE INDEX IF NOT EXISTS tracks_album ON tracks (album_name, album_artists, release_date, track_number, total_tracks);
+CREATE TABLE IF NOT EXISTS artists (
+    track_id INTEGER NOT NULL,
+    name TEXT NOT NULL COLLATE NOCASE,
+    role TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artists_name ON artists (name, track_id);
+CREATE INDEX IF NOT EXISTS artists_track ON artists (track_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5 (track_name, track_artists, album_name, lyrics);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _as_list(value):
+    if not value: return []
+    if isinstance(value, str): return [value]
+    return list(value)
+
+
+class LibraryIndex():
+    def __init__(self, index_path, library_path):
+        """
+        Persistent SQLite index over the metadata and lyrics of a library.
+
+        The index is filled incrementally: `refresh()` only reads tags of files whose size or
+        modification time changed, and downloads are added with `add_file()`.
+
+        :param index_path: path of the SQLite database
+        :param library_path: path to the music library
+        """
+        self.index_path = index_path
+        self.library_path = library_path
+
+        with self._connect() as connection:
+            connection.executescript(_SCHEMA)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.index_path, timeout=60)
+        connection.row_factory = sqlite3.Row
+        return _Connection(connection)
+
+    def _upsert(self, connection, rpath, track_info, mtime, size):
+        self._delete(connection, rpath)
+
+        track_artists = _as_list(track_info.get('track_artists'))
+        album_artists = _as_list(track_info.get('album_artists'))
+        lyrics = track_info.get('lyrics') or ''
+
+        cursor = connection.execute(
+            "INSERT INTO tracks (path, ytm_id, track_name, track_artists, album_name, album_artists, release_date, "
+            "track_number, total_tracks, has_lyrics, mtime, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                rpath, track_info.get('ytm_id', ''), track_info.get('track_name', ''), ", ".join(track_artists),
+                track_info.get('album_name', ''), ", ".join(album_artists), str(track_info.get('release_date', '')),
+                _to_int(track_info.get('track_number')), _to_int(track_info.get('total_tracks')),
+                1 if lyrics else 0, mtime, size,
+            ),
+        )
+        track_id = cursor.lastrowid
+
+        connection.executemany(
+            "INSERT INTO artists (track_id, name, role) VALUES (?, ?, ?)",
+            [(track_id, name, 'track') for name in track_artists] + [(track_id, name, 'album') for name in album_artists],
+        )
+        connection.execute(
+            "INSERT INTO tracks_fts (rowid, track_name, track_artists, album_name, lyrics) VALUES (?, ?, ?, ?, ?)",
+            (track_id, track_info.get('track_name', ''), ", ".join(track_artists), track_info.get('album_name', ''), lyrics),
+        )
+
+    def _delete(self, connection, rpath):
+        row = connection.execute("SELECT id FROM tracks WHERE path = ?", (rpath,)).fetchone()
+        if row is None: return
+
+        connection.execute("DELETE FROM tracks WHERE id = ?", (row['id'],))
+        connection.execute("DELETE FROM artists WHERE track_id = ?", (row['id'],))
+        connection.execute("DELETE FROM tracks_fts WHERE rowid = ?", (row['id'],))
+
+    def add_file(self, audio_path, track_info=None):
+        """
+        Add or update one file, e.g. right after it was downloaded.
+
+        Args:
+            audio_path (str): Path to the audio file.
+            track_info (dict, optional): Its tags, they are read from the file if not given.
+        """
+        if track_info is None:
+            track_info = tag_utils.get_tag(str(audio_path), include_cover=False) or {}
+
+        stat = os.stat(audio_path)
+        rpath = os.path.relpath(str(audio_path), start=self.library_path)
+        with self._connect() as connection:
+            self._upsert(connection, rpath, track_info, stat.st_mtime, stat.st_size)
+
+    def remove_file(self, audio_path):
+        rpath = os.path.relpath(str(audio_path), start=self.library_path)
+        with self._connect() as connection:
+            self._delete(connection, rpath)
+
+    def refresh(self):
+        """
+        Bring the index up to date with the library.
+
+        Only files that are new or whose size or modification time changed are read, files
+        that no longer exist are removed.
+
+        Returns:
+            tuple: (number of updated files, number of removed files)
+        """
+        with self._connect() as connection:
+            known = {row['path']: (row['mtime'], row['size']) for row in connection.execute("SELECT path, mtime, size FROM tracks")}
+
+            updated = 0
+            for audio_path in Path(self.library_path).rglob("*"):
+                if audio_path.suffix.lower() not in AUDIO_EXTENSIONS: continue
+
+                rpath = os.path.relpath(str(audio_path), start=self.library_path)
+
+                # Skip staging directories of workers
+                if INFO_DIR in Path(rpath).parts: continue
+
+                stat = audio_path.stat()
+                if known.pop(rpath, None) == (stat.st_mtime, stat.st_size): continue
+
+                try:
+                    track_info = tag_utils.get_tag(str(audio_path), include_cover=False) or {}
+                except Exception as e:
+                    logging_utils.logging.warning(f"Index: can't read tags of {audio_path}: {e}")
+                    track_info = {}
+                self._upsert(connection, rpath, track_info, stat.st_mtime, stat.st_size)
+                updated += 1
+
+            # Files left in `known` are gone
+            for rpath in known:
+                self._delete(connection, rpath)
+
+            connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_refresh', ?)", (str(time.time()),))
+
+        return updated, len(known)
+
+    def last_refresh(self):
+        with self._connect() as connection:
+            row = connection.execute("SELECT value FROM meta WHERE key = 'last_refresh'").fetchone()
+        return float(row['value']) if row else None
+
+    def tracks(self, text=None, artist=None, album=None, missing_lyrics=False, limit=None):
+        """
+        Find tracks in the index.
+
+        Args:
+            text (str, optional): Full-text query over titles, artists, albums and lyrics (FTS5 syntax).
+            artist (str, optional): Track or album artist (case-insensitive exact match).
+            album (str, optional): Album name (case-insensitive exact match).
+            missing_lyrics (bool): Only tracks without lyrics.
+            limit (int, optional): Maximum number of results.
+
+        Returns:
+            list[dict]: Matching tracks ordered by path.
+        """
+        query = "SELECT tracks.* FROM tracks"
+        conditions = []
+        params = []
+
+        if text:
+            query += " JOIN tracks_fts ON tracks_fts.rowid = tracks.id"
+            conditions.append("tracks_fts MATCH ?")
+            params.append(text)
+        if artist:
+            conditions.append("tracks.id IN (SELECT track_id FROM artists WHERE name = ?)")
+            params.append(artist)
+        if album:
+            conditions.append("tracks.album_name = ?")
+            params.append(album)
+        if missing_lyrics:
+            conditions.append("tracks.has_lyrics = 0")
+
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY tracks.path"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        with self._connect() as connection:
+            return [dict(row) for row in connection.execute(query, params)]
+
+    def incomplete_albums(self, artist=None):
+        """
+        Find albums with fewer tracks in the library than their `total_tracks`.
+
+        Args:
+            artist (str, optional): Only albums of this album artist (case-insensitive exact match).
+
+        Returns:
+            list[dict]: `album_name`, `album_artists`, `release_date`, `tracks` (present) and
+                `total_tracks` of every incomplete album.
+        """
+        query = (
+            "SELECT album_name, album_artists, release_date, COUNT(DISTINCT track_number) AS tracks, MAX(total_tracks) AS total_tracks "
+            "FROM tracks WHERE album_name != '' AND total_tracks IS NOT NULL"
+        )
+        params = []
+        if artist:
+            query += " AND id IN (SELECT track_id FROM artists WHERE name = ? AND role = 'album')"
+            params.append(artist)
+        query += " GROUP BY album_name, album_artists, release_date HAVING tracks < total_tracks ORDER BY album_artists, album_name"
+
+        with self._connect() as connection:
+            return [dict(row) for row in connection.execute(query, params)]
+
+
+class _Connection():
+    # Runs the block in one transaction and always closes the connection
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.connection.commit()
+            else:
+                self.connection.rollback()
+        finally:
+            self.connection.close()
@@ -1,13 +1,127 @@
 import os
+import json
+import queue
+import atexit
 import logging
+import logging.handlers
+import multiprocessing
 
-# Ensure the logs directory exists
-os.makedirs('logs', exist_ok=True)
+# Extra fields that log calls may pass with `extra={...}`
+STRUCTURED_FIELDS = ('ytm_id', 'stage', 'duration')
 
-# Configure basic logging
-logging.basicConfig(
-    level=logging.DEBUG,  # Log level: DEBUG, INFO, WARNING, ERROR, CRITICAL
-    format='%(asctime)s - %(levelname)s - %(message)s',  # Log message format
-    filename='logs/muzlib.log',   # Log to file, omit for console logging
-    filemode='w'          # Overwrite ('w') or append ('a') to log file
-)
\ No newline at end of file
+DEFAULT_LOG_PATH = os.path.join('logs', 'muzlib.log')
+
+_listener = None
+_queue_handler = None
+
+
+class _StructuredFormatter(logging.Formatter):
+    # Plain text lines, structured fields are appended as key=value
+    def format(self, record):
+        message = super().format(record)
+        fields = _record_fields(record)
+        if fields:
+            message += " [" + " ".join(f"{key}={value}" for key, value in fields.items()) + "]"
+        return message
+
+
+class _JsonFormatter(logging.Formatter):
+    # One JSON object per line, for log shippers
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            **_record_fields(record),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def _record_fields(record):
+    fields = {}
+    for key in STRUCTURED_FIELDS:
+        value = getattr(record, key, None)
+        if value is None or value == '': continue
+        fields[key] = round(value, 3) if isinstance(value, float) else value
+    return fields
+
+
+def setup_logging(level=logging.DEBUG, log_path=DEFAULT_LOG_PATH, max_bytes=10 * 1024 * 1024, backup_count=5, json_format=False):
+    """
+    Configure logging of muzlib, replacing the previous configuration.
+
+    Log calls only put the record into a queue, the file is written by a background thread,
+    so logging never blocks downloads. The log file is rotated by size instead of being
+    overwritten by every run.
+
+    Args:
+        level (int | str): Minimum level (DEBUG, INFO, WARNING, ERROR, CRITICAL).
+        log_path (str | None): Path of the log file, None or '-' logs to stderr.
+        max_bytes (int): Size at which the log file is rotated, 0 never rotates.
+        backup_count (int): Number of rotated files that are kept.
+        json_format (bool): Write JSON lines instead of plain text.
+    """
+    global _listener, _queue_handler
+
+    shutdown_logging()
+
+    if log_path and log_path != '-':
+        os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+    else:
+        handler = logging.StreamHandler()
+
+    if json_format:
+        handler.setFormatter(_JsonFormatter())
+    else:
+        handler.setFormatter(_StructuredFormatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    _queue_handler = logging.handlers.QueueHandler(log_queue)
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    root.addHandler(_queue_handler)
+
+
+def process_log_path(log_path, name):
+    """
+    Path of the log file of one of several processes that would share `log_path`.
+
+    Rotating a file that other processes still write to loses their records, so every
+    process gets its own file, e.g. `logs/muzlib.host-42.log` for `logs/muzlib.log`.
+    """
+    root, extension = os.path.splitext(log_path)
+    return f"{root}.{name}{extension}"
+
+
+def shutdown_logging():
+    """
+    Write out queued records and stop the background thread.
+    """
+    global _listener, _queue_handler
+
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
+
+# Default configuration, can be overridden by the environment or by calling `setup_logging()`.
+# Child processes (the postprocess pool) import muzlib again, they log to stderr instead of
+# rotating the log file of their parent.
+setup_logging(
+    level=os.environ.get('MUZLIB_LOG_LEVEL', 'DEBUG'),
+    log_path=os.environ.get('MUZLIB_LOG_FILE', DEFAULT_LOG_PATH) if multiprocessing.parent_process() is None else '-',
+)
@@ -1,17 +1,35 @@
 import os
 import re
+import sys
 import json
 import time
 import base64
+import textwrap
+import shutil
+import socket
 import requests
+import threading
+import multiprocessing
+from collections import deque
 from pathlib import Path
 from enum import Enum
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 
 import yt_dlp
 from ytmusicapi import YTMusic
 import questionary
 
 from . import lyrics_utils
+from . import failure_utils
+from . import schedule_utils
+from . import cover_utils
+from . import postprocess_utils
+from . import queue_utils
+from . import index_utils
+from . import verify_utils
+from . import store_utils
+from .track_utils import TrackInfo, CoverCache
 from .tag_utils import tag_utils
 from . import logging_utils
 
@@ -75,40 +93,106 @@ def _sanitize_filename(filename, replacement="_"):
     
     return sanitized
 
-def _get_image(url, retries=3, delay=2):
+def _get_image(url, retries=3, delay=2, throttle=None):
     for attempt in range(retries):
-        response = requests.get(url, timeout=10)
+        response = requests.get(url, timeout=10, stream=True)
         if response.status_code == 200:
-            return base64.b64encode(response.content).decode('utf-8')
+            content = bytearray()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                if throttle is not None: throttle(len(chunk))
+                content += chunk
+            return base64.b64encode(content).decode('utf-8')
         else:
+            response.close()
             time.sleep(delay)
 
     logging_utils.logging.warning(f"Failed to download image. Status code: {response.status_code}")
     return {}
 
+def _move_no_clobber(src, dst):
+    """
+    Move `src` to `dst` unless `dst` already exists.
+
+    Creating the target with a hardlink is atomic, so this is safe when several processes
+    (or hosts on a shared volume) race for the same target path.
+
+    :return: True if the file was moved, False if `dst` exists
+    """
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        return False
+    except OSError:
+        # Different volume: copy next to the target first, then link it into place
+        tmp_path = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copy2(src, tmp_path)
+        try:
+            os.link(tmp_path, dst)
+        except FileExistsError:
+            return False
+        except OSError:
+            # File system without hardlinks, fall back to a non-atomic check
+            if os.path.exists(dst): return False
+            os.replace(tmp_path, dst)
+        finally:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+
+    os.remove(src)
+    return True
+
+def _remove_empty_dirs(directory, root):
+    # Remove `directory` and its parents while they are empty, never `root` itself
+    root = os.path.abspath(root)
+    directory = os.path.abspath(directory)
+    while directory.startswith(root) and directory != root:
+        try:
+            os.rmdir(directory)
+        except OSError:
+            return
+        directory = os.path.dirname(directory)
+
 def _find_audio_files(directory):
     extensions = {'.mp3', '.opus'}
     
-    return [
+    return (
         p for p in Path(directory).rglob("*") 
-        if p.suffix.lower() in extensions
-    ]
-
-def _init_track_info():
-    track_info = {}
-    track_info['ytm_id'] = ""
-    track_info['ytm_title'] = ""
-    track_info['track_name'] = ""
-    track_info['track_artists'] = []
-    track_info['track_artists_str'] = ""
-    track_info['release_date'] = ""
-    track_info['album_name'] = ""
-    track_info['album_artists'] = []
-    track_info['track_number'] = ""
-    track_info['total_tracks'] = ""
-    track_info['lyrics'] = ""
-    track_info['cover'] = ""
-    return track_info
+        if p.suffix.lower() in extensions and index_utils.INFO_DIR not in p.relative_to(directory).parts
+    )
+
+def _iter_json_array(path, chunk_size=64 * 1024):
+    """
+    Yield the items of a JSON array file one by one without loading the whole file.
+    """
+    decoder = json.JSONDecoder()
+
+    with open(path, "r", encoding="utf-8") as file:
+        buffer = file.read(chunk_size).lstrip()
+        if not buffer.startswith('['):
+            raise ValueError(f"{path} does not contain a JSON array")
+        buffer = buffer[1:]
+
+        while True:
+            buffer = buffer.lstrip()
+            if buffer.startswith(','):
+                buffer = buffer[1:].lstrip()
+            if buffer.startswith(']'):
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                # The item is not complete yet, read more
+                chunk = file.read(chunk_size)
+                if not chunk: raise
+                buffer += chunk
+                continue
+
+            yield item
+            buffer = buffer[end:]
+
+# Tags kept in the verification manifest, enough to re-download and re-tag a file whose tags got lost
+_MANIFEST_TAGS = ('ytm_id', 'ytm_title', 'track_name', 'track_artists', 'release_date', 'album_name',
+                  'album_artists', 'track_number', 'total_tracks', 'duration')
 
 class SearchType(str, Enum):
     ARTIST = "artist"
@@ -116,49 +200,207 @@ class SearchType(str, Enum):
     TRACK = "track"
 
 class Muzlib():
-    def __init__(self, library_path, codec="opus", skip_downloaded=False):
+    def __init__(self, library_path, codec="opus", skip_downloaded=False,
+                 bandwidth_limit=None, worker_bandwidth_limit=None, download_windows=None,
+                 min_free_space=0, staging_path=None, cover_max_size=None, cover_quality=90,
+                 download_workers=1, postprocess_workers=None,
+                 fragment_workers=1, http_chunk_size=None, resume_partial=True, partial_max_age=7 * 24 * 60 * 60,
+                 content_store=None):
         """
         Docstring for __init__
         
         :param library_path: path to the music library
         :param codec: preferred codec for downloaded audio (opus, mp3, m4a)
         :param skip_downloaded: whether to skip already downloaded tracks based on the database
+        :param bandwidth_limit: bandwidth limit of all downloads together in bytes per second (None for unlimited)
+        :param worker_bandwidth_limit: bandwidth limit of a single download in bytes per second (None for unlimited)
+        :param download_windows: list of ("HH:MM", "HH:MM") tuples, new downloads only start inside them
+        :param min_free_space: bytes that must stay free on the library and staging volumes, downloads pause below it
+        :param staging_path: directory for downloads before they are moved into the library (library_path by default)
+        :param cover_max_size: maximum width/height of embedded covers in pixels, larger covers are downscaled (None keeps the largest cover)
+        :param cover_quality: JPEG quality of downscaled covers
+        :param download_workers: number of tracks downloaded at the same time
+        :param postprocess_workers: number of processes converting and tagging downloaded tracks (CPU count by default)
+        :param fragment_workers: number of fragments of one track downloaded at the same time (fragmented formats)
+        :param http_chunk_size: download in HTTP range requests of this many bytes (None for a single request)
+        :param resume_partial: resume .part files left by failed attempts instead of starting over
+        :param partial_max_age: seconds after which leftover .part files in the staging directory are deleted
+        :param content_store: directory of an audio store shared with other libraries, tracks found there are not downloaded again
         """
 
-        self.extension = "." + codec.lower()
+        # Postprocess workers are spawned and import the main module again. Without the guard the script
+        # would run once more in every worker, stop it here so the pool falls back to threads instead
+        if getattr(multiprocessing.current_process(), '_inheriting', False):
+            raise RuntimeError("Muzlib created while a worker process imports the main module, put the script under `if __name__ == '__main__':`")
 
+        self.codec = codec.lower()
+        self.extension = "." + self.codec
+
+        # Audio extraction runs in a separate process pool (see postprocess_utils), not in yt-dlp
         self.ydl_opts = {
             'format': 'bestaudio',
-            'outtmpl': '%(id)s.%(ext)s',
+            'outtmpl': '%(id)s.source.%(ext)s',
             'retries': 5,  # Retry 5 times for errors
-            'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': codec,
-                    'preferredquality': '0', # Best quality
-            }],
+            'fragment_retries': 5,
+            'concurrent_fragment_downloads': fragment_workers,
+            'continuedl': resume_partial,
             'quiet': True,
             'cookiefile': 'assets/cookies.txt'
         }
+        if worker_bandwidth_limit:
+            self.ydl_opts['ratelimit'] = worker_bandwidth_limit
+        if http_chunk_size:
+            self.ydl_opts['http_chunk_size'] = http_chunk_size
+
+        self.partial_max_age = partial_max_age
+
+        # Throughput of the latest downloads, see `__record_download_speed`
+        self.download_stats = deque(maxlen=1000)
 
         self.use_db = skip_downloaded
 
+        self.cover_max_size = cover_max_size
+        self.cover_quality = cover_quality
+
         self.info_path = '.muzlib'
 
         self.library_path = library_path
+        self.staging_path = staging_path
         self.db_path = "db.json"
         self.artists_rename_path = "artists_rename.json"
+        self.artists_rename_applied_path = "artists_rename.applied.json"
+        self.relayout_journal_path = "relayout.jsonl"
         self._backup_path_prefix = "muzlib_backup_"
         self.missing_path = "missing.json"
+        self.failures_path = "failures.jsonl"
+        self.queue_path = "queue.sqlite"
+        self._work_queue = None
+        self.index_path = "index.sqlite"
+        self._index = None
+        self.manifest_path = "manifest.json"
 
         self._init_library()
 
+        self.scheduler = schedule_utils.DownloadScheduler(
+            bandwidth_limit=bandwidth_limit,
+            download_windows=download_windows,
+            min_free_space=min_free_space,
+            watch_paths=[self.library_path, self.staging_path],
+        )
+        self.ydl_opts['progress_hooks'] = [self.scheduler.progress_hook, self.__record_download_speed]
+        self._cleanup_partial_downloads()
+
+        self.covers = CoverCache()
+        self._cover_urls = {}
+
+        self.store = store_utils.ContentStore(content_store) if content_store else None
+
         self.db = {}
+        self._db_lock = threading.Lock()
+        self._db_file_lock = queue_utils.FileLock(self.db_path + ".lock")
+        self._db_signature = None
         self.__load_db()
 
+        self.failures = failure_utils.FailureJournal(self.failures_path)
+        self.failures.import_legacy(os.path.join(self.library_path, self.missing_path))
+
         self.ytmusic = YTMusic()
-        self.ydl = yt_dlp.YoutubeDL(self.ydl_opts)
+        self._local = threading.local()
+
+        # I/O-bound downloads feed the CPU-bound conversion pool
+        self.download_workers = download_workers
+        self.postprocess_workers = postprocess_workers or os.cpu_count() or 1
+        self._download_pool = ThreadPoolExecutor(max_workers=self.download_workers, thread_name_prefix="muzlib-download")
+        # Moves get their own threads, queued behind downloads they could wait for space those downloads need
+        self._finish_pool = ThreadPoolExecutor(max_workers=self.download_workers, thread_name_prefix="muzlib-finish")
+        self._postprocess_pool = None
+        self._pool_lock = threading.Lock()
+        # Whether the current postprocess pool has finished a task, a pool that never did can't start its workers
+        self._postprocess_started = False
+
+    @property
+    def ydl(self):
+        # YoutubeDL is not thread-safe, every worker thread gets its own instance
+        if not hasattr(self._local, 'ydl'):
+            self._local.ydl = yt_dlp.YoutubeDL(self.ydl_opts)
+        return self._local.ydl
+
+    def __record_download_speed(self, d):
+        # yt-dlp progress hook, reports the throughput of every finished download
+        if d.get('status') != 'finished': return
+
+        downloaded = d.get('downloaded_bytes') or d.get('total_bytes') or 0
+        elapsed = d.get('elapsed') or 0
+        stats = {
+            'ytm_id': (d.get('info_dict') or {}).get('id', ''),
+            'bytes': downloaded,
+            'seconds': elapsed,
+            'bytes_per_second': downloaded / elapsed if elapsed else 0,
+        }
+        self.download_stats.append(stats)
+        logging_utils.logging.info(
+            f"Downloaded {stats['ytm_id']}: {stats['bytes']} bytes in {stats['seconds']:.1f} s ({stats['bytes_per_second'] / 1024:.0f} KiB/s)",
+            extra={'ytm_id': stats['ytm_id'], 'stage': 'download', 'duration': elapsed},
+        )
 
-        
+    def _cleanup_partial_downloads(self):
+        """
+        Delete partial downloads in the staging directory that are too old to be resumed.
+        """
+        now = time.time()
+        for entry in os.scandir(self.staging_path):
+            if not entry.is_file() or not entry.name.endswith(('.part', '.ytdl')): continue
+            if now - entry.stat().st_mtime > self.partial_max_age:
+                os.remove(entry.path)
+                logging_utils.logging.debug(f"Removed stale partial download {entry.path}")
+
+    @property
+    def postprocess_pool(self):
+        # Created on first use, spawned workers don't inherit the download threads
+        with self._pool_lock:
+            if self._postprocess_pool is None:
+                self._postprocess_pool = ProcessPoolExecutor(
+                    max_workers=self.postprocess_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+            return self._postprocess_pool
+
+    def __replace_postprocess_pool(self, broken):
+        with self._pool_lock:
+            # Every track of the broken pool gets here, only the first one replaces it
+            if self._postprocess_pool is not broken: return
+
+            if self._postprocess_started:
+                logging_utils.logging.warning("Postprocess workers died, starting new ones")
+                self._postprocess_pool = None
+            else:
+                # Spawned workers import the main module again, a script without
+                # `if __name__ == '__main__':` makes each of them crash on start
+                logging_utils.logging.warning(
+                    "Postprocess workers can't start (is the main script missing `if __name__ == '__main__':`?), "
+                    "converting tracks in threads instead"
+                )
+                self._postprocess_pool = ThreadPoolExecutor(max_workers=self.postprocess_workers, thread_name_prefix="muzlib-postprocess")
+            self._postprocess_started = False
+        broken.shutdown(wait=False)
+
+    def close(self):
+        """
+        Wait for running downloads and stop the worker pools.
+        """
+        # In pipeline order, every stage may still hand tracks to the next one
+        self._download_pool.shutdown(wait=True)
+
+        # A broken postprocess pool is replaced while its tracks are resubmitted, wait for the replacement as well
+        while True:
+            with self._pool_lock:
+                pool = self._postprocess_pool
+            if pool is None: break
+            pool.shutdown(wait=True)
+            with self._pool_lock:
+                if self._postprocess_pool is pool: break
+
+        self._finish_pool.shutdown(wait=True)
     
     def _init_library(self):
 
@@ -172,15 +414,24 @@ class Muzlib():
         except Exception as e:
             logging_utils.logging.error(f"Error creating folders: {e}")
 
-        self.ydl_opts['outtmpl'] = os.path.join(self.library_path, self.ydl_opts['outtmpl'])
+        # Staging directory for downloads in progress
+        self.staging_path = os.path.join(self.staging_path or self.library_path, '')
+        os.makedirs(self.staging_path, exist_ok=True)
+        self.ydl_opts['outtmpl'] = os.path.join(self.staging_path, self.ydl_opts['outtmpl'])
 
         # Database path
         self.info_path = os.path.join(self.library_path, self.info_path)
         os.makedirs(self.info_path, exist_ok=True)
         self.db_path = os.path.join(self.info_path, self.db_path)
+        self.failures_path = os.path.join(self.info_path, self.failures_path)
+        self.queue_path = os.path.join(self.info_path, self.queue_path)
+        self.index_path = os.path.join(self.info_path, self.index_path)
+        self.manifest_path = os.path.join(self.info_path, self.manifest_path)
 
         # Artists_rename
         self.artists_rename_path = os.path.join(self.info_path, self.artists_rename_path)
+        self.artists_rename_applied_path = os.path.join(self.info_path, self.artists_rename_applied_path)
+        self.relayout_journal_path = os.path.join(self.info_path, self.relayout_journal_path)
         if not os.path.exists(self.artists_rename_path):
             with open(self.artists_rename_path, "w", encoding="utf-8") as file:
                 json.dump({}, file, indent=4, ensure_ascii=False)
@@ -189,6 +440,12 @@ class Muzlib():
             with open(self.artists_rename_path, "r", encoding="utf-8") as file:
                 self.artists_rename = json.load(file)
 
+        # The map downloads use from now on, relayout() compares later edits with it
+        self._artists_rename_opened = dict(self.artists_rename)
+        if not os.path.exists(self.artists_rename_applied_path):
+            with open(self.artists_rename_applied_path, "w", encoding="utf-8") as file:
+                json.dump(self.artists_rename, file, indent=4, ensure_ascii=False)
+
         
     def _artist_rename(self, artist_name):
         if artist_name in self.artists_rename: return self.artists_rename[artist_name]
@@ -196,40 +453,69 @@ class Muzlib():
     
     def _get_album_metadata(self, ytm_album_id, single_id=None, single_name=None):
         album_metadata = []
+        downloads = []
 
         album_details = self.ytmusic.get_album(ytm_album_id)
+
         for track in album_details['tracks']:
-            track_info = _init_track_info()
-            track_info['ytm_id'] = track['videoId']
-            track_info['track_name'] = _trackname_remove_unnecessary(track['title'])
+            track_info = TrackInfo()
+            track_info.ytm_id = track['videoId']
+            track_info.track_name = _trackname_remove_unnecessary(track['title'])
 
             # Single downloading
             if not single_name is None and not single_id is None and len(album_details['tracks']) > 1:
-                if track['title'] != single_name and track_info['ytm_id'] != single_id:
+                if track['title'] != single_name and track_info.ytm_id != single_id:
                     continue
 
-            track_info['track_artists'] = [_replace_slash(self._artist_rename(artist['name'])) for artist in track['artists']] + _get_feat_artists(track['title'])
-            track_info['track_artists_str'] = ", ".join(track_info['track_artists'])
-            track_info['release_date'] = album_details['year'] if 'year' in album_details else ''
+            track_info.track_artists = [_replace_slash(self._artist_rename(artist['name'])) for artist in track['artists']] + _get_feat_artists(track['title'])
+            track_info.track_artists_str = ", ".join(track_info.track_artists)
+            track_info.release_date = album_details['year'] if 'year' in album_details else ''
 
             # TODO: Set album and track number in singles too
             if album_details['trackCount'] > 1:
-                track_info['album_name'] = _trackname_remove_unnecessary(album_details['title'])
-                track_info['track_number'] = track['trackNumber']
-                track_info['total_tracks'] = album_details['trackCount']
+                track_info.album_name = _trackname_remove_unnecessary(album_details['title'])
+                track_info.track_number = track['trackNumber']
+                track_info.total_tracks = album_details['trackCount']
 
-            track_info['album_artists'] = [_replace_slash(self._artist_rename(artist['name'])) for artist in album_details['artists']] + _get_feat_artists(track_info['album_name'])
-            track_info['lyrics'] = lyrics_utils.get_lyrics(track_info['track_name'], track_info['track_artists_str'], ytmusic=self.ytmusic, id=track_info['ytm_id'])
-            track_info['cover'] = _get_image(album_details['thumbnails'][-1]['url'])
-            track_info['ytm_title'] = f"{track_info['track_artists_str']} - {track['title']}"
+            track_info.duration = track.get('duration_seconds') or ''
 
-            # Download the track
-            self._download_by_track_info(track_info)
+            track_info.album_artists = [_replace_slash(self._artist_rename(artist['name'])) for artist in album_details['artists']] + _get_feat_artists(track_info.album_name)
+            # Tracks already in the library are skipped by the download, don't fetch their lyrics and cover (resyncs)
+            if not (self.use_db and track_info.ytm_id in self.db):
+                track_info.lyrics = lyrics_utils.get_lyrics(track_info.track_name, track_info.track_artists_str, ytmusic=self.ytmusic, id=track_info.ytm_id) or ''
+                track_info.cover_hash = self._get_cover(album_details['thumbnails'])
+            track_info.ytm_title = f"{track_info.track_artists_str} - {track['title']}"
+
+            # Download the track, metadata of the next track is fetched meanwhile
+            downloads.append(self._submit_download(track_info))
 
             album_metadata.append(track_info)
         
+        wait(downloads)
         return album_metadata
     
+    def _get_cover(self, thumbnails):
+        """
+        Download and normalize an album cover once, all tracks of the album share the result.
+
+        :param thumbnails: YTM thumbnails of the album
+        :return: hash of the cover in `self.covers` ('' if there is no cover), pinned until the track is released
+        """
+        if not thumbnails: return ''
+
+        url = cover_utils.select_thumbnail(thumbnails, self.cover_max_size)
+        cover_hash = self._cover_urls.get(url, '')
+        if cover_hash and self.covers.pin(cover_hash):
+            return cover_hash
+
+        cover = _get_image(url, throttle=self.scheduler.throttle)
+        if not cover: return ''
+
+        data, mime, width, height = cover_utils.normalize_cover(base64.b64decode(cover), self.cover_max_size, self.cover_quality)
+        cover_hash = self.covers.put(base64.b64encode(data).decode('utf-8'), mime, width, height, pin=True)
+        self._cover_urls[url] = cover_hash
+        return cover_hash
+
     def search(self, search_term, search_type: SearchType):
         if search_type == SearchType.ARTIST:
             return self.ytmusic.search(search_term, filter="artists")
@@ -299,10 +585,10 @@ class Muzlib():
     
         return ''
 
-    def _get_discography_by_artist_id(self,artist_id):
-        
+    def _get_discography_albums(self, artist_id):
         artist_details = self.ytmusic.get_artist(artist_id)
 
+        discography = []
         for type in ["albums", "singles"]:
             if not type in artist_details: continue
 
@@ -311,8 +597,13 @@ class Muzlib():
             if artist_details[type]['browseId']:
                 albums = self.ytmusic.get_artist_albums(artist_details[type]['browseId'], params=None, limit=None)
             
-            for album in albums:
-                self._get_album_metadata(album['browseId'])
+            discography.extend(albums)
+
+        return discography
+
+    def _get_discography_by_artist_id(self,artist_id):
+        for album in self._get_discography_albums(artist_id):
+            self._get_album_metadata(album['browseId'])
 
     
     def download_artist_discography(self, artist_name, download_top_result=False):
@@ -366,23 +657,23 @@ class Muzlib():
 
 
     def backup_library(self):
-        track_metadata = []
-        audio_files = _find_audio_files(self.library_path)
-        for audio_path in audio_files:
-            track_info = tag_utils.get_tag(str(audio_path))
-
-            audio_rpath = os.path.relpath(str(audio_path), start=self.library_path)
-            name, ext = os.path.splitext(audio_rpath)
-            track_info['path'] = name
-
-            track_metadata.append(track_info)
-        
-
         formatted_timestamp = time.strftime('%Y%m%d%H%M%S', time.localtime())
         backup_path = os.path.join(self.info_path, f'{self._backup_path_prefix}{formatted_timestamp}.json')
 
+        # Tracks are written one by one, so memory does not grow with the library size
         with open(backup_path, "w", encoding="utf-8") as file:
-            json.dump(track_metadata, file, indent=4, ensure_ascii=False)
+            file.write("[")
+            separator = "\n"
+            for audio_path in _find_audio_files(self.library_path):
+                track_info = tag_utils.get_tag(str(audio_path))
+
+                audio_rpath = os.path.relpath(str(audio_path), start=self.library_path)
+                name, ext = os.path.splitext(audio_rpath)
+                track_info['path'] = name
+
+                file.write(separator + textwrap.indent(json.dumps(track_info, indent=4, ensure_ascii=False), "    "))
+                separator = ",\n"
+            file.write("\n]")
         
         return backup_path
             
@@ -394,90 +685,288 @@ class Muzlib():
             print(f"File {backup_filepath} is directory.")
             return
         
-        track_metadata = []
-        with open(backup_filepath, "r", encoding="utf-8") as file:
-            track_metadata = json.load(file)
-        
-        for track_info in track_metadata:
-            self._download_by_track_info(track_info)   
+        # Stream the backup instead of loading every track (and cover) at once
+        self._download_many(_iter_json_array(backup_filepath))
 
     def _download_by_track_info(self, track_info):
+        """
+        Download, tag and move one track and wait until it is done.
+
+        :param track_info: TrackInfo or track dictionary (backups, failure journal)
+        :return: True if the track is in the library afterwards, False otherwise
+        """
+        return self._submit_download(track_info).result()
+
+    def _download_many(self, track_infos):
+        """
+        Run the download pipeline for many tracks, keeping only a bounded number of them in flight.
+
+        :param track_infos: iterable of TrackInfo or track dictionaries
+        :return: number of tracks that are in the library afterwards
+        """
+        in_flight = threading.BoundedSemaphore(2 * (self.download_workers + self.postprocess_workers))
+        downloads = []
+
+        for track_info in track_infos:
+            in_flight.acquire()
+            download = self._submit_download(track_info)
+            download.add_done_callback(lambda _: in_flight.release())
+            downloads.append(download)
+
+        wait(downloads)
+        return sum(download.result() for download in downloads)
+
+    def _submit_download(self, track_info):
+        """
+        Start the pipeline of one track: download (I/O pool) -> convert and tag (CPU pool) -> move.
+
+        Failures are recorded in the failure journal.
+
+        :param track_info: TrackInfo or track dictionary (backups, failure journal)
+        :return: Future resolving to True if the track is in the library afterwards, False otherwise
+        """
+        if isinstance(track_info, dict):
+            track_info = TrackInfo.from_dict(track_info, self.covers)
+
+        result = Future()
+
+        if not track_info.ytm_id:
+            track_info.release(self.covers)
+            result.set_result(False)
+            return result
+
+        if self.use_db and track_info.ytm_id in self.db:
+            self.failures.record_success(track_info.ytm_id)
+            track_info.release(self.covers)
+            result.set_result(True)
+            return result
+
+        self._download_pool.submit(self.__download_stage, track_info, result)
+        return result
+
+    def __download_stage(self, track_info, result):
         try:
-            id = track_info.get('ytm_id','')
-            if not id: return
+            id = track_info.ytm_id
+            file_path = os.path.join(self.staging_path, f"{id}{self.extension}")
 
-            if self.use_db and id in self.db: return
+            if self.store is not None and self.store.materialize(id, self.codec, file_path, track_info.duration):
+                # Another library already downloaded the track, only the tags of this library are written
+                logging_utils.logging.debug(f"Took {id} from the content store", extra={'ytm_id': id, 'stage': 'download'})
+                self.__postprocess(track_info, result, tag_utils.add_tag, file_path, track_info.to_dict(self.covers))
+            else:
+                source_path, source_codec = self.__download_track_youtube(id)
 
-            self.__download_track_youtube(id)
-            
-            file_path = os.path.join(self.library_path, f"{id}{self.extension}")
+                # Convert and add tag to the track in the CPU pool, this worker continues downloading
+                self.__postprocess(
+                    track_info, result, postprocess_utils.convert_and_tag,
+                    source_path, file_path, self.codec, source_codec, track_info.to_dict(self.covers), self.store,
+                )
+        except Exception as e:
+            self.__track_failed(track_info, e, result, stage='download')
+
+    def __postprocess(self, track_info, result, fn, *args, retry=True):
+        pool = self.postprocess_pool
+        submitted = time.monotonic()
+        try:
+            postprocess = pool.submit(fn, *args)
+        except BrokenProcessPool as e:
+            postprocess = Future()
+            postprocess.set_exception(e)
+        postprocess.add_done_callback(lambda future: self.__postprocess_done(future, pool, track_info, result, submitted, fn, args, retry))
+
+    def __postprocess_done(self, postprocess, pool, track_info, result, submitted, fn, args, retry):
+        broken = not postprocess.cancelled() and isinstance(postprocess.exception(), BrokenProcessPool)
+        if broken and retry:
+            # The track wasn't converted, run it again in a new pool
+            self.__replace_postprocess_pool(pool)
+            self.__postprocess(track_info, result, fn, *args, retry=False)
+            return
+        if not broken:
+            self._postprocess_started = True
+
+        # The source is gone now, the space reserved for it must not block the next admission
+        self.scheduler.release(track_info.ytm_id)
+
+        # Moving is I/O again, hand it to the finish pool instead of blocking the CPU pool's thread
+        try:
+            self._finish_pool.submit(self.__finish_stage, postprocess, track_info, result, submitted)
+        except RuntimeError as e:
+            self.__track_failed(track_info, e, result, stage='move')
+
+    def __finish_stage(self, postprocess, track_info, result, submitted):
+        stage = 'postprocess'
+        try:
+            postprocess.result()
+            logging_utils.logging.debug(
+                f"Converted and tagged {track_info.ytm_id}",
+                extra={'ytm_id': track_info.ytm_id, 'stage': stage, 'duration': time.monotonic() - submitted},
+            )
 
-            # Add tag to the track
-            tag_utils.add_tag(file_path,track_info)
+            stage = 'move'
+            started = time.monotonic()
 
             # Rename and move track
-            self.__move_downloaded_track(id, track_info)
-            
+            new_path = self.__move_downloaded_track(track_info.ytm_id, track_info)
+            self.__index_file(new_path, track_info)
+
             # Save database
-            self.db[id] = track_info['track_artists_str'] + " - " + track_info['track_name']
-            self.__write_db()
+            self._update_db({track_info.ytm_id: track_info.track_artists_str + " - " + track_info.track_name})
+            logging_utils.logging.info(
+                f"Moved {track_info.ytm_id} to {new_path}",
+                extra={'ytm_id': track_info.ytm_id, 'stage': stage, 'duration': time.monotonic() - started},
+            )
+
+            self.failures.record_success(track_info.ytm_id)
+            track_info.release(self.covers)
+            result.set_result(True)
         except Exception as e:
-            missing_path = os.path.join(self.library_path, self.missing_path)
+            self.__track_failed(track_info, e, result, stage=stage)
+
+    def __track_failed(self, track_info, error, result, stage=None):
+        self.scheduler.release(track_info.ytm_id)
+        entry = self.failures.record_failure(track_info.to_dict(self.covers), error)
+
+        # Partial downloads are kept for resuming, unless the track will not be retried soon
+        if entry['class'] == failure_utils.FailureClass.PERMANENT.value:
+            for path in Path(self.staging_path).glob(f"{track_info.ytm_id}.source.*"):
+                path.unlink(missing_ok=True)
+        logging_utils.logging.error(
+            f"Error downloading track {track_info.track_name or 'Unknown'} with id {track_info.ytm_id or 'Unknown'} ({entry['class']}): {error}",
+            extra={'ytm_id': track_info.ytm_id, 'stage': stage},
+        )
+        print(f"Error downloading track {track_info.track_name or 'Unknown'} with id {track_info.ytm_id or 'Unknown'}: {error}")
+
+        # Lyrics and cover are in the failure journal now
+        track_info.release(self.covers)
+        result.set_result(False)
+
+    def retry_failed(self, include_permanent=False):
+        """
+        Retry failed downloads whose backoff has expired.
 
-            if os.path.exists(missing_path):
-                with open(missing_path, "r", encoding="utf-8") as file:
-                    missing_track_metadata = json.load(file)
-                missing_track_metadata.append(track_info)
-            else:
-                missing_track_metadata = [track_info]
-            
-            json.dump(missing_track_metadata, open(missing_path, "w", encoding="utf-8"), indent=4, ensure_ascii=False)
-            logging_utils.logging.error(f"Error downloading track {track_info.get('track_name','Unknown')} with id {track_info.get('ytm_id','Unknown')}: {e}")
-            print(f"Error downloading track {track_info.get('track_name','Unknown')} with id {track_info.get('ytm_id','Unknown')}: {e}")            
+        Retries go through the normal download pipeline and run concurrently (see `download_workers`).
+        Tracks that fail again are rescheduled with a longer delay according to their failure class.
 
-    def __move_downloaded_track(self, id, track_info):
-        file_path = os.path.join(self.library_path, f"{id}{self.extension}")
+        :param include_permanent: also retry permanent failures (e.g. unavailable videos)
+        :return: tuple (number of retried tracks, number of recovered tracks)
+        """
+        due = self.failures.due(include_permanent=include_permanent)
+        if not due: return 0, 0
+
+        print(f"Retrying {len(due)} failed tracks")
+
+        recovered = self._download_many(self.failures.track_info(entry) for entry in due)
+
+        self.failures.compact()
+        return len(due), recovered
 
+    def add_to_store(self, workers=8):
+        """
+        Add the tracks of this library to the content store, so other libraries can take them
+        from there instead of downloading them. Only files in the codec of this library are added,
+        without their tags.
+
+        :param workers: number of files copied at the same time
+        :return: number of tracks added to the store
+        """
+        if self.store is None:
+            raise ValueError("Muzlib was created without a content store")
+
+        def add_one(audio_path):
+            if audio_path.suffix.lower() != self.extension: return False
+            try:
+                track_info = tag_utils.get_tag(str(audio_path), include_cover=False) or {}
+                if not track_info.get('ytm_id'): return False
+                # Broken files would spread to every library
+                if verify_utils.check_audio(str(audio_path), track_info.get('duration')): return False
+                return self.store.add(str(audio_path), track_info['ytm_id'], self.codec, strip_tags=True)
+            except Exception as e:
+                logging_utils.logging.warning(f"Store: can't add {audio_path}: {e}")
+                return False
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return sum(executor.map(add_one, _find_audio_files(self.library_path)))
+
+    def _track_relpath(self, track_info):
+        """
+        Path of a track inside the library (without extension) according to the layout rules.
+        """
         # Specify filename
-        new_filename = _sanitize_filename(_replace_slash(track_info['track_artists_str'] + " - " + track_info['track_name']))
-        if track_info['track_number']:
-            new_filename = f"{track_info['track_number']}. {new_filename}"
+        new_filename = _sanitize_filename(_replace_slash(track_info.track_artists_str + " - " + track_info.track_name))
+        if track_info.track_number:
+            new_filename = f"{track_info.track_number}. {new_filename}"
 
-        artist_dir = _sanitize_filename(track_info['track_artists'][0])
+        artist_dir = _sanitize_filename(track_info.track_artists[0])
 
         album_dir = ''
-        if track_info['total_tracks']:
-            album_dir = _sanitize_filename(_replace_slash(f"[{track_info['release_date']}] {track_info['album_name']}"))
+        if track_info.total_tracks:
+            album_dir = _sanitize_filename(_replace_slash(f"[{track_info.release_date}] {track_info.album_name}"))
 
         # Join path components
-        new_path = os.path.join(artist_dir, album_dir, new_filename)
+        return os.path.join(artist_dir, album_dir, new_filename)
 
-        # If file exists
-        if os.path.exists(os.path.join(self.library_path,new_path + self.extension)):
-            new_path = os.path.join("DUPLICATE", new_path)
+    def __move_downloaded_track(self, id, track_info):
+        file_path = os.path.join(self.staging_path, f"{id}{self.extension}")
 
-        # If there is specified path in track_info
-        if 'path' in track_info:
-            new_path = os.path.normpath(track_info['path'])
+        # If there is specified path in track_info (its tags may be incomplete, e.g. broken files found by verify)
+        if track_info.path:
+            new_path = os.path.normpath(track_info.path)
+        else:
+            new_path = self._track_relpath(track_info)
 
         new_path = os.path.join(self.library_path, new_path + self.extension)
 
         os.makedirs(os.path.dirname(new_path), exist_ok=True)
-        os.rename(file_path, new_path)
+
+        # Moving from another volume writes the whole file to the library
+        if os.stat(file_path).st_dev != os.stat(os.path.dirname(new_path)).st_dev:
+            self.scheduler.wait_for_space(self.library_path, os.path.getsize(file_path), key=id)
+
+        if track_info.path:
+            shutil.move(file_path, new_path)
+        elif not _move_no_clobber(file_path, new_path):
+            # If file exists (possibly written by another worker at the same moment)
+            new_path = os.path.join(self.library_path, "DUPLICATE", os.path.relpath(new_path, self.library_path))
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            shutil.move(file_path, new_path)
+
         print(f"Successfully downloaded {new_path}")
+        return new_path
+
+    def __index_file(self, audio_path, track_info):
+        # The index is only a cache of the tags, a failure must not fail the download
+        try:
+            self.index.add_file(audio_path, track_info.to_dict(self.covers))
+        except Exception as e:
+            logging_utils.logging.warning(f"Index: can't add {audio_path}: {e}")
 
 
     def __download_track_youtube(self,track_id):
         # Construct the URL for YouTube Music
         track_url = f"https://music.youtube.com/watch?v={track_id}"
 
+        # Resolve the format first to know the expected size before anything is written
+        info = self.ydl.extract_info(track_url, download=False)
+        estimated_size = info.get('filesize') or info.get('filesize_approx') or 0
+
+        # Source and converted file exist side by side during the conversion
+        self.scheduler.wait_for_admission(2 * estimated_size, key=track_id)
+
         # Download using yt-dlp
-        self.ydl.download([track_url])
+        info = self.ydl.process_ie_result(info, download=True)
+
+        downloads = info.get('requested_downloads') or [info]
+        source_path = downloads[0].get('filepath') or self.ydl.prepare_filename(info)
+        return source_path, info.get('acodec', '')
     
     def __write_db(self):
-        # write database to the db.json file
-        with open(self.db_path, "w", encoding="utf-8") as file:
+        # write database to the db.json file, atomically so other processes never read half of it
+        tmp_path = f"{self.db_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
             json.dump(self.db, file, indent=4, ensure_ascii=False)
+            file.flush()
+            self._db_signature = _file_signature(os.fstat(file.fileno()))
+        os.replace(tmp_path, self.db_path)
 
     def __load_db(self):
         # fetch database from db.json file
@@ -486,8 +975,497 @@ class Muzlib():
 
         with open(self.db_path, "r", encoding="utf-8") as file:
             self.db = json.load(file)
+            # Of the file that was read, db.json may be replaced right after opening it
+            self._db_signature = _file_signature(os.fstat(file.fileno()))
+
+    def _update_db(self, updates=None, removals=()):
+        """
+        Add and remove database entries and save the database.
+
+        Other processes (workers on other hosts) may share db.json, so the file is re-read
+        under a lock when it changed and the entries are merged into it.
+
+        :param updates: dict ytm_id -> "artists - track name" to add
+        :param removals: ytm_ids to remove
+        """
+        with self._db_lock, self._db_file_lock:
+            # mtime alone misses writes within its resolution, every write replaces the file with a new inode
+            try:
+                changed = _file_signature(os.stat(self.db_path)) != self._db_signature
+            except FileNotFoundError:
+                changed = False
+            if changed:
+                self.__load_db()
+
+            self.db.update(updates or {})
+            for id in removals:
+                self.db.pop(id, None)
+
+            self.__write_db()
+
+    @property
+    def index(self):
+        # Local metadata index of the library (see `query()`)
+        if self._index is None:
+            self._index = index_utils.LibraryIndex(self.index_path, self.library_path)
+        return self._index
 
-def main():
+    def refresh_index(self):
+        """
+        Update the metadata index with files that were added, changed or removed outside of muzlib.
+
+        :return: tuple (number of updated files, number of removed files)
+        """
+        return self.index.refresh()
+
+    def query(self, text=None, artist=None, album=None, missing_lyrics=False, limit=None):
+        """
+        Search the library using the local metadata index (built on first use).
+
+        :param text: full-text query over titles, artists, albums and lyrics (FTS5 syntax)
+        :param artist: track or album artist
+        :param album: album name
+        :param missing_lyrics: only tracks without lyrics
+        :param limit: maximum number of results
+        :return: list of track dictionaries (path relative to the library)
+        """
+        if self.index.last_refresh() is None:
+            self.refresh_index()
+        return self.index.tracks(text=text, artist=artist, album=album, missing_lyrics=missing_lyrics, limit=limit)
+
+    def incomplete_albums(self, artist=None):
+        """
+        Find albums that have fewer tracks in the library than they should (track_number vs total_tracks).
+
+        :param artist: only albums of this album artist
+        :return: list of dictionaries with album_name, album_artists, release_date, tracks and total_tracks
+        """
+        if self.index.last_refresh() is None:
+            self.refresh_index()
+        return self.index.incomplete_albums(artist=artist)
+
+    def verify(self, workers=8, full=False, repair=False):
+        """
+        Check the integrity of the library files in parallel.
+
+        A file passes if its container can be read, its length matches the length reported by
+        YouTube Music (looked up for files without a duration tag) and its required tags are present.
+        Results are kept in a checksum manifest, later runs only verify files whose size or modification
+        time changed. Broken files are removed from the database and queued in the failure journal for
+        re-download to the same path.
+
+        :param workers: number of files verified at the same time
+        :param full: verify every file and compare it with the stored checksum (detects silent corruption)
+        :param repair: re-download broken files right away instead of on the next `retry_failed()`
+        :return: list of dictionaries with `path` (relative, with extension), `ytm_id` and `problems`
+        """
+        manifest = {}
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as file:
+                manifest = json.load(file)
+
+        checks = {}
+        seen = set()
+        for audio_path in _find_audio_files(self.library_path):
+            rpath = os.path.relpath(str(audio_path), start=self.library_path)
+            seen.add(rpath)
+
+            stat = audio_path.stat()
+            entry = manifest.get(rpath)
+            # Files whose length couldn't be looked up are checked again
+            if entry and (entry['size'], entry['mtime']) == (stat.st_size, stat.st_mtime) and not entry.get('duration_unverified'):
+                if not full: continue
+                checks[rpath] = (stat, entry['sha256'])
+            else:
+                checks[rpath] = (stat, None)
+
+        # Files that are gone don't need to be tracked anymore
+        for rpath in set(manifest) - seen:
+            del manifest[rpath]
+
+        def verify_one(rpath):
+            try:
+                return rpath, verify_utils.verify_file(
+                    os.path.join(self.library_path, rpath), checks[rpath][1],
+                    expected_duration=manifest.get(rpath, {}).get('tags', {}).get('duration'),
+                    duration_lookup=self.__ytm_duration,
+                )
+            except OSError as e:
+                return rpath, {'sha256': '', 'problems': [f"unreadable file: {e}"], 'track_info': {}, 'duration': ''}
+
+        broken = []
+        unverified = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for rpath, result in executor.map(verify_one, checks):
+                stat = checks[rpath][0]
+                # Tags of a broken file may be gone, the tags from the last verification still identify it
+                tags = manifest.get(rpath, {}).get('tags', {})
+                if result['track_info'].get('ytm_id'):
+                    tags = {key: result['track_info'].get(key, '') for key in _MANIFEST_TAGS}
+                # A length looked up on YouTube Music is kept for the next verification
+                tags['duration'] = tags.get('duration') or result['duration']
+                ytm_id = tags.get('ytm_id', '')
+                manifest[rpath] = {
+                    'size': stat.st_size,
+                    'mtime': stat.st_mtime,
+                    'sha256': result['sha256'],
+                    'ytm_id': ytm_id,
+                    'tags': tags,
+                    'problems': result['problems'],
+                }
+                if result['problems']:
+                    broken.append({'path': rpath, 'ytm_id': ytm_id, 'problems': result['problems'], 'tags': tags})
+                elif not result['duration']:
+                    manifest[rpath]['duration_unverified'] = True
+                    unverified.append(rpath)
+
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(manifest, file, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+
+        for rpath in unverified:
+            logging_utils.logging.warning(f"Verify: {rpath}: duration unverified, its length on YouTube Music is unknown")
+        if unverified:
+            print(f"{len(unverified)} files passed without a duration check, their length on YouTube Music is unknown")
+
+        redownloads = []
+        for track in broken:
+            logging_utils.logging.warning(f"Verify: {track['path']}: {'; '.join(track['problems'])}")
+            if not track['ytm_id']:
+                print(f"Can't re-download {track['path']}, its YouTube Music id is unknown")
+                continue
+
+            # Re-download to the same path, with the metadata that is still readable
+            track_info = self.__verify_track_info(track)
+            self.failures.record_failure(track_info, f"verification failed: {'; '.join(track['problems'])}")
+            redownloads.append(track_info)
+
+        if redownloads:
+            self._update_db(removals=[track_info['ytm_id'] for track_info in redownloads])
+            if repair:
+                self._download_many(redownloads)
+                self.failures.compact()
+
+        return [{'path': track['path'], 'ytm_id': track['ytm_id'], 'problems': track['problems']} for track in broken]
+
+    def __ytm_duration(self, ytm_id):
+        # Length of a track in seconds according to YouTube Music, '' if it can't be looked up
+        try:
+            return self.ytmusic.get_song(ytm_id)['videoDetails']['lengthSeconds']
+        except Exception as e:
+            logging_utils.logging.debug(f"Verify: can't look up the length of {ytm_id}: {e}", extra={'ytm_id': ytm_id})
+            return ''
+
+    def __verify_track_info(self, track):
+        audio_path = os.path.join(self.library_path, track['path'])
+        try:
+            file_tags = tag_utils.get_tag(audio_path) or {}
+        except Exception:
+            file_tags = {}
+
+        # Tags still in the file (with lyrics and cover) win over the last good tags of the manifest
+        track_info = {**track['tags'], **{key: value for key, value in file_tags.items() if value}}
+        track_info['track_artists'] = list(track_info.get('track_artists') or [])
+        track_info['album_artists'] = list(track_info.get('album_artists') or [])
+        track_info['track_artists_str'] = ", ".join(track_info['track_artists'])
+        track_info['ytm_id'] = track['ytm_id']
+        track_info['path'] = os.path.splitext(track['path'])[0]
+        return track_info
+
+    def _artists_rename_changes(self):
+        # Map of artist names as they are in the library -> names according to the current artists_rename.json.
+        # Without a snapshot of the last applied map, files may carry the original names or the names
+        # of the map the library was opened with.
+        if os.path.isfile(self.artists_rename_applied_path):
+            with open(self.artists_rename_applied_path, "r", encoding="utf-8") as file:
+                applied = json.load(file)
+            old_names = lambda name: {applied.get(name, name)}
+        else:
+            applied = self._artists_rename_opened
+            old_names = lambda name: {name, applied.get(name, name)}
+
+        changes = {}
+        for name in set(applied) | set(self.artists_rename):
+            new_name = _replace_slash(self.artists_rename.get(name, name))
+            for old_name in map(_replace_slash, old_names(name)):
+                if old_name != new_name:
+                    changes[old_name] = new_name
+        return changes
+
+    def relayout(self, dry_run=False, workers=8):
+        """
+        Apply changes of artists_rename.json to tracks that are already in the library.
+
+        Only files whose artist tags contain a renamed artist are touched: their tags are rewritten
+        (the audio is not re-encoded) and files that follow the default layout are moved to their new
+        path. Progress is journaled, an interrupted relayout is finished by the next call and files
+        that failed are retried by it.
+
+        :param dry_run: only return the planned changes
+        :param workers: number of files processed at the same time
+        :return: list of dictionaries with `src`, `dst` (relative paths with extension) and `track_artists`
+        """
+        with open(self.artists_rename_path, "r", encoding="utf-8") as file:
+            self.artists_rename = json.load(file)
+
+        self._relayout_lock = threading.Lock()
+        changes = self._artists_rename_changes()
+
+        plans = {}
+        for src, entry in self.__relayout_journal_entries().items():
+            if entry['status'] == 'failed':
+                # Failed files still carry the names from before their relayout
+                plans[src] = self.__relayout_retry_plan(entry, changes)
+            elif dry_run:
+                continue
+            elif os.path.exists(os.path.join(self.library_path, src)):
+                # Interrupted before the move, the tags may already carry the new names
+                plans[src] = self.__relayout_plan(src, changes, dst=entry['dst'])
+            else:
+                # Interrupted after the move, only the bookkeeping is missing
+                self.__relayout_complete_moved(src, entry['dst'])
+
+        if changes:
+            self.refresh_index()
+            for old_name in changes:
+                for track in self.index.tracks(artist=old_name):
+                    if track['path'] not in plans:
+                        plans[track['path']] = self.__relayout_plan(track['path'], changes)
+
+        plans = [plan for plan in plans.values() if plan is not None]
+        if dry_run or not plans:
+            if not dry_run: self.__finish_relayout()
+            return plans
+
+        print(f"Relayout of {len(plans)} tracks")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(self.__relayout_file, plans))
+
+        self.__finish_relayout()
+        return plans
+
+    def __relayout_plan(self, rpath, changes, dst=None):
+        audio_path = os.path.join(self.library_path, rpath)
+        try:
+            track_info = tag_utils.get_tag(audio_path, include_cover=False) or {}
+        except Exception as e:
+            logging_utils.logging.warning(f"Relayout: can't read tags of {audio_path}: {e}")
+            return None
+
+        old_track = TrackInfo.from_dict(track_info, self.covers)
+        new_track = TrackInfo.from_dict(track_info, self.covers)
+        new_track.track_artists = [changes.get(artist, artist) for artist in new_track.track_artists]
+        new_track.album_artists = [changes.get(artist, artist) for artist in new_track.album_artists]
+        new_track.track_artists_str = ", ".join(new_track.track_artists)
+
+        name, extension = os.path.splitext(rpath)
+        if dst is None:
+            dst = rpath
+            # Files at custom paths (e.g. restored from a backup) keep their place
+            if old_track.track_artists and name in (self._track_relpath(old_track), os.path.join("DUPLICATE", self._track_relpath(old_track))):
+                dst = self._track_relpath(new_track) + extension
+
+        return {
+            'src': rpath,
+            'dst': dst,
+            'ytm_id': new_track.ytm_id,
+            'track_artists': new_track.track_artists,
+            'album_artists': new_track.album_artists,
+            'track_name': new_track.track_name,
+        }
+
+    def __relayout_retry_plan(self, entry, changes):
+        # The failed plan holds the names of its relayout, renames made since then apply on top of them
+        if not os.path.exists(os.path.join(self.library_path, entry['src'])): return None
+
+        plan = {key: entry[key] for key in ('src', 'dst', 'ytm_id', 'track_artists', 'album_artists', 'track_name')}
+        plan['track_artists'] = [changes.get(artist, artist) for artist in plan['track_artists']]
+        plan['album_artists'] = [changes.get(artist, artist) for artist in plan['album_artists']]
+
+        if plan['dst'] != plan['src'] and plan['track_artists']:
+            track_info = tag_utils.get_tag(os.path.join(self.library_path, plan['src']), include_cover=False) or {}
+            new_track = TrackInfo.from_dict(track_info, self.covers)
+            new_track.track_artists = plan['track_artists']
+            new_track.track_artists_str = ", ".join(plan['track_artists'])
+            new_track.track_name = plan['track_name']
+            plan['dst'] = self._track_relpath(new_track) + os.path.splitext(plan['src'])[1]
+        return plan
+
+    def __relayout_complete_moved(self, src, dst):
+        dst_path = os.path.join(self.library_path, dst)
+        if not os.path.exists(dst_path):
+            dst_path = os.path.join(self.library_path, "DUPLICATE", dst)
+        if not os.path.exists(dst_path):
+            logging_utils.logging.error(f"Relayout: neither {src} nor {dst} exists, dropping it from the journal")
+            self.__relayout_journal_append({'src': src, 'dst': dst, 'status': 'done'})
+            return
+
+        # The tags were rewritten before the move
+        track_info = tag_utils.get_tag(dst_path, include_cover=False) or {}
+        self.index.remove_file(os.path.join(self.library_path, src))
+        self.index.add_file(dst_path, track_info)
+        _remove_empty_dirs(os.path.dirname(os.path.join(self.library_path, src)), self.library_path)
+        if track_info.get('ytm_id') in self.db:
+            self._update_db({track_info['ytm_id']: ", ".join(track_info['track_artists']) + " - " + track_info['track_name']})
+
+        self.__relayout_journal_append({'src': src, 'dst': dst, 'status': 'done'})
+
+    def __relayout_file(self, plan):
+        try:
+            src = os.path.join(self.library_path, plan['src'])
+            dst = os.path.join(self.library_path, plan['dst'])
+            self.__relayout_journal_append({'src': plan['src'], 'dst': plan['dst'], 'status': 'pending'})
+
+            # Rewrite only the tags, everything else (cover, lyrics) is taken over from the file
+            track_info = tag_utils.get_tag(src)
+            track_info['track_artists'] = plan['track_artists']
+            track_info['album_artists'] = plan['album_artists']
+            track_info['track_artists_str'] = ", ".join(plan['track_artists'])
+            tag_utils.add_tag(src, track_info)
+
+            if dst != src:
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                if not _move_no_clobber(src, dst):
+                    dst = os.path.join(self.library_path, "DUPLICATE", plan['dst'])
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    shutil.move(src, dst)
+                self.index.remove_file(src)
+                _remove_empty_dirs(os.path.dirname(src), self.library_path)
+
+            self.index.add_file(dst)
+            if plan['ytm_id'] and plan['ytm_id'] in self.db:
+                self._update_db({plan['ytm_id']: track_info['track_artists_str'] + " - " + plan['track_name']})
+
+            self.__relayout_journal_append({'src': plan['src'], 'dst': plan['dst'], 'status': 'done'})
+        except Exception as e:
+            logging_utils.logging.error(f"Relayout: failed for {plan['src']}: {e}")
+            print(f"Relayout failed for {plan['src']}: {e}")
+            # Kept in the journal and retried by the next relayout
+            self.__relayout_journal_append({**plan, 'status': 'failed', 'error': str(e)})
+
+    def __relayout_journal_append(self, entry):
+        with self._relayout_lock:
+            with open(self.relayout_journal_path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def __relayout_journal_entries(self):
+        # Latest entry of every file that is not done (status pending or failed)
+        entries = {}
+        if not os.path.isfile(self.relayout_journal_path): return entries
+
+        with open(self.relayout_journal_path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry['status'] == 'done':
+                    entries.pop(entry['src'], None)
+                else:
+                    entries[entry['src']] = entry
+        return entries
+
+    def __finish_relayout(self):
+        # Everything is applied once no move is left over, remember the applied map
+        entries = self.__relayout_journal_entries()
+        if any(entry['status'] == 'pending' for entry in entries.values()): return
+
+        with open(self.artists_rename_applied_path, "w", encoding="utf-8") as file:
+            json.dump(self.artists_rename, file, indent=4, ensure_ascii=False)
+
+        # Only failed files stay in the journal, for the next relayout
+        if entries:
+            tmp_path = f"{self.relayout_journal_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                for entry in entries.values():
+                    file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.relayout_journal_path)
+        elif os.path.exists(self.relayout_journal_path):
+            os.remove(self.relayout_journal_path)
+
+    @property
+    def work_queue(self):
+        # Shared job queue on the library volume (see `work()`)
+        if self._work_queue is None:
+            self._work_queue = queue_utils.WorkQueue(self.queue_path)
+        return self._work_queue
+
+    def enqueue(self, kind, payload):
+        """
+        Add a job to the shared work queue of the library.
+
+        :param kind: queue_utils.JobKind (artist, album, track, restore)
+        :param payload: artist/album: {"browse_id": ...}, track: {"album_id": ..., "video_id": ..., "title": ...},
+            restore: {"track_info": {...}}
+        :return: True if the job was added, False if it is already queued
+        """
+        return self.work_queue.put(kind, payload)
+
+    def enqueue_search_result(self, search_result, search_type: SearchType):
+        """
+        Queue the download of a search result instead of downloading it right away.
+        """
+        if search_type == SearchType.ARTIST:
+            return self.enqueue(queue_utils.JobKind.ARTIST, {'browse_id': search_result['browseId']})
+        elif search_type == SearchType.ALBUM:
+            return self.enqueue(queue_utils.JobKind.ALBUM, {'browse_id': search_result['browseId']})
+        elif search_type == SearchType.TRACK:
+            return self.enqueue(queue_utils.JobKind.TRACK, {'album_id': search_result['album']['id'], 'video_id': search_result['videoId'], 'title': search_result['title']})
+        else:
+            logging_utils.logging.error(f"Invalid search type: {search_type}")
+            print(f"Invalid search type: {search_type}")
+            return False
+
+    def enqueue_restore(self, backup_filepath, batch_size=500):
+        """
+        Queue every track of a backup file, so several workers can restore it together.
+
+        :return: number of queued tracks
+        """
+        queued = 0
+        batch = []
+        for track_info in _iter_json_array(backup_filepath):
+            batch.append({'track_info': track_info})
+            if len(batch) >= batch_size:
+                queued += self.work_queue.put_many(queue_utils.JobKind.RESTORE, batch)
+                batch = []
+        if batch:
+            queued += self.work_queue.put_many(queue_utils.JobKind.RESTORE, batch)
+        return queued
+
+    def run_job(self, kind, payload):
+        """
+        Run one job of the work queue.
+
+        Artist jobs are split into album jobs, so several workers can share one discography.
+        """
+        kind = queue_utils.JobKind(kind)
+        if kind == queue_utils.JobKind.ARTIST:
+            albums = self._get_discography_albums(payload['browse_id'])
+            self.work_queue.put_many(queue_utils.JobKind.ALBUM, [{'browse_id': album['browseId']} for album in albums])
+        elif kind == queue_utils.JobKind.ALBUM:
+            self._get_album_metadata(payload['browse_id'])
+        elif kind == queue_utils.JobKind.TRACK:
+            self._get_album_metadata(payload['album_id'], single_id=payload['video_id'], single_name=payload['title'])
+        elif kind == queue_utils.JobKind.RESTORE:
+            self._download_by_track_info(payload['track_info'])
+
+    def work(self, worker_id=None, exit_when_empty=False, stop_event=None):
+        """
+        Run as a worker of the shared work queue.
+
+        Several workers (processes on one or more hosts sharing the library volume) can run at
+        the same time, every job is claimed by only one of them.
+
+        :param worker_id: unique name of the worker (`<hostname>-<pid>` by default)
+        :param exit_when_empty: stop once the queue is drained instead of waiting for new jobs
+        :param stop_event: threading.Event that stops the worker after the current job
+        :return: number of completed jobs
+        """
+        return queue_utils.run_worker(self.work_queue, self.run_job, worker_id=worker_id, exit_when_empty=exit_when_empty, stop_event=stop_event)
+
+def interactive():
     from rich.console import Console
     from rich.panel import Panel
     from rich.prompt import Prompt
@@ -547,5 +1525,269 @@ def main():
         ml.download_by_search_result(selected_result, download_type)
         console.print(f"[green]✓ Done![/green]")
 
+
+def _add_library_arguments(parser):
+    parser.add_argument("library_path", help="path to the music library")
+    parser.add_argument("--codec", default="opus", help="preferred codec for downloaded audio (opus, mp3, m4a)")
+
+
+def _cmd_enqueue(args):
+    ml = Muzlib(args.library_path, codec=args.codec)
+
+    if args.kind == queue_utils.JobKind.RESTORE.value:
+        print(f"Queued {ml.enqueue_restore(args.query)} tracks")
+        return
+
+    search_type = SearchType(args.kind)
+    search_results = ml.search(args.query, search_type)
+    if not search_results:
+        print(f"Nothing found for {args.query}")
+        return
+
+    if ml.enqueue_search_result(search_results[0], search_type):
+        print(f"Queued {args.kind} {args.query}")
+    else:
+        print(f"{args.kind} {args.query} is already queued")
+
+
+def _file_signature(stat):
+    # Identifies a version of a file, see `Muzlib._update_db`
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _adopt_stale_staging(staging_root, staging_path, max_age):
+    """
+    Take over the downloads of workers of this host that are not running anymore, so they are
+    resumed, and remove leftovers of other workers that are older than `max_age` seconds.
+    """
+    if not os.path.isdir(staging_root): return
+
+    hostname = socket.gethostname()
+    now = time.time()
+    for directory in os.scandir(staging_root):
+        if not directory.is_dir() or os.path.abspath(directory.path) == os.path.abspath(staging_path): continue
+
+        # Directories are named after the default worker id <hostname>-<pid>
+        prefix, _, pid = directory.name.rpartition('-')
+        dead = prefix == hostname and pid.isdigit() and not _pid_alive(int(pid))
+
+        for entry in os.scandir(directory.path):
+            if not entry.is_file(): continue
+            target = os.path.join(staging_path, entry.name)
+            # Partial and complete downloads are picked up by yt-dlp, converted files may be incomplete
+            if dead and '.source.' in entry.name and not os.path.exists(target):
+                os.makedirs(staging_path, exist_ok=True)
+                os.replace(entry.path, target)
+                logging_utils.logging.info(f"Adopted {entry.path} of stopped worker {directory.name}")
+            elif dead or now - entry.stat().st_mtime > max_age:
+                os.remove(entry.path)
+
+        try:
+            os.rmdir(directory.path)
+        except OSError:
+            pass
+
+
+def _cmd_worker(args):
+    worker_id = args.id or queue_utils.default_worker_id()
+
+    # Every worker stages its downloads separately, several workers may fetch the same track
+    staging_root = os.path.join(args.library_path, '.muzlib', 'staging')
+    staging_path = args.staging or os.path.join(staging_root, worker_id)
+    if not args.staging:
+        _adopt_stale_staging(staging_root, staging_path, max_age=7 * 24 * 60 * 60)
+
+    ml = Muzlib(args.library_path, codec=args.codec, skip_downloaded=True, staging_path=staging_path,
+                download_workers=args.download_workers, postprocess_workers=args.postprocess_workers,
+                content_store=args.store)
+    try:
+        completed = ml.work(worker_id=worker_id, exit_when_empty=args.exit_when_empty)
+    finally:
+        ml.close()
+    print(f"Worker {worker_id} completed {completed} jobs")
+
+
+def _cmd_query(args):
+    # Queries only need the index, not the YouTube clients
+    library_path = os.path.join(args.library_path, '')
+    index = index_utils.LibraryIndex(os.path.join(library_path, '.muzlib', 'index.sqlite'), library_path)
+
+    if args.refresh or index.last_refresh() is None:
+        updated, removed = index.refresh()
+        print(f"Index updated: {updated} files read, {removed} removed")
+
+    if args.incomplete_albums:
+        for album in index.incomplete_albums(artist=args.artist):
+            print(f"{album['album_artists']} - [{album['release_date']}] {album['album_name']}: {album['tracks']}/{album['total_tracks']}")
+        return
+
+    for track in index.tracks(text=args.text, artist=args.artist, album=args.album, missing_lyrics=args.missing_lyrics, limit=args.limit):
+        print(track['path'])
+
+
+def _cmd_serve(args):
+    from . import daemon_utils
+
+    ml = Muzlib(args.library_path, codec=args.codec, skip_downloaded=True,
+                download_workers=args.download_workers, postprocess_workers=args.postprocess_workers,
+                content_store=args.store)
+    daemon = daemon_utils.MuzlibDaemon(ml, host=args.host, port=args.port, sync_interval=args.sync_interval * 60 * 60)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ml.close()
+
+
+def _cmd_relayout(args):
+    ml = Muzlib(args.library_path, codec=args.codec)
+    try:
+        plans = ml.relayout(dry_run=args.dry_run, workers=args.workers)
+    finally:
+        ml.close()
+
+    for plan in plans:
+        print(f"{plan['src']} -> {plan['dst']} ({', '.join(plan['track_artists'])})")
+    print(f"{len(plans)} tracks {'would be ' if args.dry_run else ''}updated")
+
+
+def _cmd_verify(args):
+    ml = Muzlib(args.library_path, codec=args.codec)
+    try:
+        broken = ml.verify(workers=args.workers, full=args.full, repair=args.repair)
+    finally:
+        ml.close()
+
+    for track in broken:
+        print(f"{track['path']}: {'; '.join(track['problems'])}")
+    print(f"{len(broken)} broken tracks{'' if args.repair else ', run with --repair or muzlib retry to re-download them'}")
+
+
+def _cmd_retry(args):
+    ml = Muzlib(args.library_path, codec=args.codec, download_workers=args.download_workers)
+    try:
+        retried, recovered = ml.retry_failed(include_permanent=args.include_permanent)
+    finally:
+        ml.close()
+    print(f"Recovered {recovered} of {retried} retried tracks, {len(ml.failures.pending())} still failing")
+
+
+def _cmd_publish(args):
+    ml = Muzlib(args.library_path, codec=args.codec, content_store=args.store)
+    try:
+        added = ml.add_to_store(workers=args.workers)
+    finally:
+        ml.close()
+    print(f"Added {added} tracks to {args.store}")
+
+
+def _build_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="muzlib", description="Create your own music library. Run without arguments for the interactive mode.")
+    parser.add_argument("--log-level", help="minimum level of logged messages (DEBUG by default)")
+    parser.add_argument("--log-file", help=f"path of the log file ({logging_utils.DEFAULT_LOG_PATH} by default, '-' logs to stderr)")
+    parser.add_argument("--log-max-bytes", type=int, default=10 * 1024 * 1024, help="size at which the log file is rotated")
+    parser.add_argument("--log-backups", type=int, default=5, help="number of rotated log files that are kept")
+    parser.add_argument("--log-json", action="store_true", help="write the log as JSON lines")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="add a job to the shared work queue of a library")
+    _add_library_arguments(enqueue_parser)
+    enqueue_parser.add_argument("kind", choices=[kind.value for kind in queue_utils.JobKind], help="job type, restore takes a backup file")
+    enqueue_parser.add_argument("query", help="search term (top result is queued) or backup file path")
+    enqueue_parser.set_defaults(func=_cmd_enqueue)
+
+    worker_parser = subparsers.add_parser("worker", help="process jobs of the shared work queue of a library")
+    _add_library_arguments(worker_parser)
+    worker_parser.add_argument("--id", help="unique worker name (<hostname>-<pid> by default)")
+    worker_parser.add_argument("--staging", help="staging directory (inside .muzlib/staging by default)")
+    worker_parser.add_argument("--download-workers", type=int, default=1, help="tracks downloaded at the same time")
+    worker_parser.add_argument("--postprocess-workers", type=int, default=None, help="conversion processes (CPU count by default)")
+    worker_parser.add_argument("--exit-when-empty", action="store_true", help="stop once the queue is drained")
+    worker_parser.add_argument("--store", help="content store shared with other libraries")
+    worker_parser.set_defaults(func=_cmd_worker)
+
+    query_parser = subparsers.add_parser("query", help="search the library using the local metadata index")
+    query_parser.add_argument("library_path", help="path to the music library")
+    query_parser.add_argument("text", nargs="?", help="full-text query over titles, artists, albums and lyrics")
+    query_parser.add_argument("--artist", help="track or album artist")
+    query_parser.add_argument("--album", help="album name")
+    query_parser.add_argument("--missing-lyrics", action="store_true", help="only tracks without lyrics")
+    query_parser.add_argument("--incomplete-albums", action="store_true", help="list albums with missing tracks")
+    query_parser.add_argument("--limit", type=int, help="maximum number of results")
+    query_parser.add_argument("--refresh", action="store_true", help="update the index with changes in the library first")
+    query_parser.set_defaults(func=_cmd_query)
+
+    serve_parser = subparsers.add_parser("serve", help="run as a daemon that accepts jobs over HTTP and resyncs watched artists")
+    _add_library_arguments(serve_parser)
+    serve_parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    serve_parser.add_argument("--port", type=int, default=8765, help="port to listen on")
+    serve_parser.add_argument("--sync-interval", type=float, default=24, help="hours between resyncs of the watch list")
+    serve_parser.add_argument("--download-workers", type=int, default=1, help="tracks downloaded at the same time")
+    serve_parser.add_argument("--postprocess-workers", type=int, default=None, help="conversion processes (CPU count by default)")
+    serve_parser.add_argument("--store", help="content store shared with other libraries")
+    serve_parser.set_defaults(func=_cmd_serve)
+
+    relayout_parser = subparsers.add_parser("relayout", help="apply changes of artists_rename.json to the existing library")
+    _add_library_arguments(relayout_parser)
+    relayout_parser.add_argument("--dry-run", action="store_true", help="only show what would change")
+    relayout_parser.add_argument("--workers", type=int, default=8, help="files processed at the same time")
+    relayout_parser.set_defaults(func=_cmd_relayout)
+
+    verify_parser = subparsers.add_parser("verify", help="check the library files and queue broken ones for re-download")
+    _add_library_arguments(verify_parser)
+    verify_parser.add_argument("--workers", type=int, default=8, help="files verified at the same time")
+    verify_parser.add_argument("--full", action="store_true", help="verify all files, not only changed ones, and compare checksums")
+    verify_parser.add_argument("--repair", action="store_true", help="re-download broken files right away")
+    verify_parser.set_defaults(func=_cmd_verify)
+
+    retry_parser = subparsers.add_parser("retry", help="retry failed downloads whose backoff has expired")
+    _add_library_arguments(retry_parser)
+    retry_parser.add_argument("--include-permanent", action="store_true", help="also retry permanent failures (e.g. unavailable videos)")
+    retry_parser.add_argument("--download-workers", type=int, default=1, help="tracks downloaded at the same time")
+    retry_parser.set_defaults(func=_cmd_retry)
+
+    publish_parser = subparsers.add_parser("publish", help="add the tracks of a library to a shared content store")
+    _add_library_arguments(publish_parser)
+    publish_parser.add_argument("store", help="directory of the content store")
+    publish_parser.add_argument("--workers", type=int, default=8, help="files copied at the same time")
+    publish_parser.set_defaults(func=_cmd_publish)
+
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        interactive()
+        return
+
+    args = _build_parser().parse_args(argv)
+    log_path = args.log_file or os.environ.get('MUZLIB_LOG_FILE', logging_utils.DEFAULT_LOG_PATH)
+    if args.command == "worker" and log_path != '-':
+        # Workers usually run side by side, each one writes and rotates its own file
+        log_path = logging_utils.process_log_path(log_path, args.id or queue_utils.default_worker_id())
+    logging_utils.setup_logging(
+        level=args.log_level or os.environ.get('MUZLIB_LOG_LEVEL', 'DEBUG'),
+        log_path=log_path,
+        max_bytes=args.log_max_bytes,
+        backup_count=args.log_backups,
+        json_format=args.log_json,
+    )
+    args.func(args)
+
+
 if __name__ == "__main__":
     main()
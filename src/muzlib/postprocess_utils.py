@@ -0,0 +1,80 @@
+import os
+import subprocess
+
+from .tag_utils import tag_utils
+from . import verify_utils
+
+
+# FFmpeg audio arguments per target codec
+CODEC_ARGS = {
+    'mp3': ['-c:a', 'libmp3lame', '-q:a', '0'],
+    'opus': ['-c:a', 'libopus', '-b:a', '160k'],
+    'm4a': ['-c:a', 'aac', '-b:a', '256k'],
+    'flac': ['-c:a', 'flac'],
+    'wav': ['-c:a', 'pcm_s16le'],
+}
+
+# yt-dlp `acodec` prefixes that can be remuxed into the target codec without re-encoding
+COPY_CODECS = {
+    'mp3': ('mp3',),
+    'opus': ('opus',),
+    'm4a': ('mp4a', 'aac'),
+}
+
+
+def extract_audio(source_path, target_path, codec, source_codec=''):
+    """
+    Convert a downloaded file into the target codec with FFmpeg.
+
+    The audio stream is copied when it already uses the target codec, like yt-dlp's
+    `FFmpegExtractAudio` does.
+
+    Args:
+        source_path (str): Path to the file downloaded by yt-dlp.
+        target_path (str): Path of the converted file.
+        codec (str): Target codec (mp3, opus, m4a, flac, wav).
+        source_codec (str): Audio codec of the source as reported by yt-dlp (`acodec`).
+    """
+    if (source_codec or '').lower().startswith(COPY_CODECS.get(codec, ())):
+        codec_args = ['-c:a', 'copy']
+    else:
+        codec_args = CODEC_ARGS[codec]
+
+    command = ['ffmpeg', '-y', '-nostdin', '-loglevel', 'error', '-i', source_path, '-vn', '-map_metadata', '-1', *codec_args, target_path]
+    result = subprocess.run(command, capture_output=True, text=True)
+
+    if result.returncode != 0:
+        if os.path.exists(target_path): os.remove(target_path)
+        raise RuntimeError(f"FFmpeg failed to convert {source_path}: {result.stderr.strip()}")
+
+
+def convert_and_tag(source_path, target_path, codec, source_codec, track_info, store=None):
+    """
+    Postprocessing stage of a download, runs in the CPU worker pool.
+
+    Converts the downloaded file, removes the source and writes the tags. A truncated download
+    or a broken conversion raises instead of being tagged and moved into the library.
+    The untagged audio is added to the shared content store `store` (store_utils.ContentStore) if given.
+
+    Returns:
+        str: Path of the converted and tagged file.
+    """
+    try:
+        extract_audio(source_path, target_path, codec, source_codec)
+    finally:
+        if os.path.exists(source_path): os.remove(source_path)
+
+    problems = verify_utils.check_audio(target_path, track_info.get('duration'))
+    if problems:
+        os.remove(target_path)
+        raise RuntimeError(f"Converted file {target_path} is incomplete: {'; '.join(problems)}")
+
+    if store is not None:
+        try:
+            store.add(target_path, track_info['ytm_id'], codec)
+        except OSError:
+            # The store only saves downloads of other libraries, this download is fine without it
+            pass
+
+    tag_utils.add_tag(target_path, track_info)
+    return target_path
@@ -0,0 +1,283 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from enum import Enum
+
+from . import logging_utils
+
+
+class JobKind(str, Enum):
+    ARTIST = "artist"
+    ALBUM = "album"
+    TRACK = "track"
+    RESTORE = "restore"
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class FileLock():
+    def __init__(self, lock_path, stale_after=120, poll_interval=0.05):
+        """
+        Inter-process (and inter-host) lock based on exclusive creation of a lock file.
+
+        Exclusive creation also works on network file systems, unlike `flock`. A lock file
+        older than `stale_after` seconds is considered abandoned by a crashed process.
+
+        :param lock_path: path of the lock file
+        :param stale_after: seconds after which an existing lock file is broken
+        :param poll_interval: seconds between attempts to take the lock
+        """
+        self.lock_path = lock_path
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+
+    def acquire(self):
+        while True:
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, default_worker_id().encode('utf-8'))
+                os.close(fd)
+                return
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.lock_path) > self.stale_after:
+                        logging_utils.logging.warning(f"Lock: breaking stale lock {self.lock_path}")
+                        os.remove(self.lock_path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(self.poll_interval)
+
+    def release(self):
+        try:
+            os.remove(self.lock_path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class WorkQueue():
+    def __init__(self, queue_path, lease_seconds=300, max_attempts=3):
+        """
+        Job queue shared by several worker processes (possibly on different hosts) through SQLite.
+
+        A worker claims a job with a lease and has to renew it with `heartbeat()`. Jobs whose
+        lease expired (crashed or disconnected worker) are handed out again.
+
+        :param queue_path: path of the SQLite database, usually on the shared library volume
+        :param lease_seconds: how long a claimed job stays reserved without a heartbeat
+        :param max_attempts: failed jobs are retried until they failed this many times
+        """
+        self.queue_path = queue_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        with self._connect() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL UNIQUE,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    owner TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    updated REAL
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires)")
+
+    def _connect(self):
+        # A new connection per operation: connections can't be shared between threads and
+        # short transactions keep the database lock free for other hosts
+        connection = sqlite3.connect(self.queue_path, timeout=60, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return _Transaction(connection)
+
+    def _job_key(self, kind, payload, payload_json):
+        # Restore entries carry the whole track (with cover), identify them by id and target path
+        if kind == JobKind.RESTORE.value:
+            track_info = payload.get('track_info', {})
+            return f"{kind}:{track_info.get('ytm_id', '')}:{track_info.get('path', '')}"
+        return f"{kind}:{payload_json}"
+
+    def put(self, kind, payload):
+        """
+        Add a job unless the same job is already queued.
+
+        Returns:
+            bool: True if the job was added, False if it was a duplicate.
+        """
+        return self.put_many(kind, [payload]) == 1
+
+    def put_many(self, kind, payloads):
+        """
+        Add several jobs of one kind in a single transaction, skipping duplicates.
+
+        Returns:
+            int: Number of added jobs.
+        """
+        kind = JobKind(kind).value
+        now = time.time()
+        rows = []
+        for payload in payloads:
+            payload_json = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+            rows.append((kind, self._job_key(kind, payload, payload_json), payload_json, now))
+
+        with self._connect() as connection:
+            before = connection.total_changes
+            connection.executemany("INSERT OR IGNORE INTO jobs (kind, key, payload, updated) VALUES (?, ?, ?, ?)", rows)
+            return connection.total_changes - before
+
+    def claim(self, owner):
+        """
+        Lease the oldest available job to `owner`.
+
+        Returns:
+            dict | None: The job (`id`, `kind`, `payload`, `attempts`) or None if nothing is available.
+        """
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT id, kind, payload, attempts FROM jobs "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None: return None
+
+            connection.execute(
+                "UPDATE jobs SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                (owner, now + self.lease_seconds, now, row['id']),
+            )
+
+        return {'id': row['id'], 'kind': row['kind'], 'payload': json.loads(row['payload']), 'attempts': row['attempts'] + 1}
+
+    def heartbeat(self, job_id, owner):
+        """
+        Extend the lease of a job. Returns False if the job is no longer leased to `owner`.
+        """
+        now = time.time()
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET lease_expires = ?, updated = ? WHERE id = ? AND owner = ? AND status = 'leased'",
+                (now + self.lease_seconds, now, job_id, owner),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, owner):
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = 'done', lease_expires = NULL, error = NULL, updated = ? WHERE id = ? AND owner = ?",
+                (time.time(), job_id, owner),
+            )
+
+    def fail(self, job_id, owner, error):
+        """
+        Give a job back after an error, it becomes `failed` after `max_attempts` attempts.
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "lease_expires = NULL, error = ?, updated = ? WHERE id = ? AND owner = ?",
+                (self.max_attempts, str(error), time.time(), job_id, owner),
+            )
+
+    def stats(self):
+        """
+        Returns:
+            dict: Number of jobs per status (pending, leased, done, failed).
+        """
+        with self._connect() as connection:
+            rows = connection.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status").fetchall()
+        stats = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+        stats.update({row['status']: row['count'] for row in rows})
+        return stats
+
+    def is_drained(self):
+        """
+        True if no job is waiting and no job is running (running jobs may still add new ones).
+        """
+        stats = self.stats()
+        return stats['pending'] == 0 and stats['leased'] == 0
+
+
+class _Transaction():
+    # Connection wrapper that runs the block in one write transaction and always closes the connection
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        # Take the write lock up front so two workers can't claim the same job
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.connection.close()
+
+
+def run_worker(queue, handler, worker_id=None, poll_interval=10, exit_when_empty=False, stop_event=None):
+    """
+    Claim and run jobs from `queue` until stopped.
+
+    Args:
+        queue (WorkQueue): Shared job queue.
+        handler (callable): Called as `handler(kind, payload)` for every job, raising marks the job as failed.
+        worker_id (str, optional): Unique name of this worker, `<hostname>-<pid>` by default.
+        poll_interval (float): Seconds to wait when the queue is empty.
+        exit_when_empty (bool): Return once no job is pending or running instead of waiting for new ones.
+        stop_event (threading.Event, optional): Set to stop the worker after the current job.
+
+    Returns:
+        int: Number of jobs this worker completed.
+    """
+    worker_id = worker_id or default_worker_id()
+    stop_event = stop_event or threading.Event()
+    completed = 0
+
+    while not stop_event.is_set():
+        job = queue.claim(worker_id)
+        if job is None:
+            if exit_when_empty and queue.is_drained(): break
+            stop_event.wait(poll_interval)
+            continue
+
+        logging_utils.logging.info(f"Worker {worker_id}: running {job['kind']} job {job['id']} (attempt {job['attempts']})")
+
+        # Keep the lease alive while the job runs
+        done = threading.Event()
+        def heartbeat():
+            while not done.wait(queue.lease_seconds / 3):
+                if not queue.heartbeat(job['id'], worker_id):
+                    logging_utils.logging.warning(f"Worker {worker_id}: lost lease of job {job['id']}")
+                    return
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+
+        try:
+            handler(job['kind'], job['payload'])
+            queue.complete(job['id'], worker_id)
+            completed += 1
+        except Exception as e:
+            logging_utils.logging.error(f"Worker {worker_id}: job {job['id']} failed: {e}")
+            queue.fail(job['id'], worker_id, e)
+        finally:
+            done.set()
+            heartbeat_thread.join()
+
+    return completed
@@ -0,0 +1,177 @@
+import time
+import shutil
+import datetime
+import threading
+
+from . import logging_utils
+
+
+def _parse_time(value):
+    if isinstance(value, datetime.time): return value
+    hours, minutes = value.split(':')
+    return datetime.time(int(hours), int(minutes))
+
+
+class TokenBucket():
+    def __init__(self, rate, capacity=None):
+        """
+        Thread-safe token bucket used to cap the total bandwidth of all workers.
+
+        :param rate: allowed rate in bytes per second
+        :param capacity: maximum burst in bytes (one second of traffic by default)
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """
+        Take `amount` bytes out of the bucket, sleeping until enough tokens are available.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+
+            # Go into debt instead of splitting large chunks, the sleep pays it back
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class DownloadScheduler():
+    def __init__(self, bandwidth_limit=None, download_windows=None, min_free_space=0, watch_paths=(), poll_interval=30):
+        """
+        Decide when a new download may start and how fast running downloads may go.
+
+        :param bandwidth_limit: global bandwidth limit in bytes per second shared by all workers (None for unlimited)
+        :param download_windows: list of ("HH:MM", "HH:MM") tuples; new downloads only start inside one of them
+            (windows may wrap around midnight, None allows downloading at any time)
+        :param min_free_space: bytes that must stay free on every watched volume
+        :param watch_paths: paths whose volumes are checked for free space (library, staging)
+        :param poll_interval: seconds between checks while admission is paused
+        """
+        self.bucket = TokenBucket(bandwidth_limit) if bandwidth_limit else None
+        self.download_windows = [(_parse_time(start), _parse_time(end)) for start, end in download_windows or []]
+        self.min_free_space = min_free_space
+        self.watch_paths = list(watch_paths)
+        self.poll_interval = poll_interval
+
+        # Bytes reported so far per file, yt-dlp calls the hook from the fragment threads of one file too
+        self._progress = {}
+        self._progress_lock = threading.Lock()
+
+        # Space promised to admitted downloads that are not in the library yet, by key (ytm_id)
+        self._reservations = {}
+        self._reservation_lock = threading.Lock()
+        self._admission_lock = threading.Lock()
+
+    @property
+    def reserved(self):
+        with self._reservation_lock:
+            return sum(self._reservations.values())
+
+    def in_window(self, now=None):
+        if not self.download_windows: return True
+
+        now = (now or datetime.datetime.now()).time()
+        for start, end in self.download_windows:
+            if start <= end:
+                if start <= now < end: return True
+            elif now >= start or now < end:
+                return True
+        return False
+
+    def free_space(self, path):
+        return shutil.disk_usage(path).free
+
+    def has_space(self, required=0, paths=None):
+        """
+        Check that every watched volume keeps `min_free_space` bytes free after writing `required` bytes
+        and the bytes reserved by admitted downloads.
+        """
+        reserved = self.reserved
+        for path in paths or self.watch_paths:
+            if self.free_space(path) < self.min_free_space + reserved + required:
+                return False
+        return True
+
+    def wait_for_admission(self, estimated_size=0, key=None):
+        """
+        Block until a new download may start: inside a download window and with enough free space
+        for `estimated_size` bytes.
+
+        The space is reserved under `key` until `release(key)`, so concurrent downloads are not
+        admitted against the same free bytes.
+        """
+        paused = False
+        while True:
+            # Checking and reserving happen together, or two workers could take the same bytes
+            with self._admission_lock:
+                if self.in_window() and self.has_space(estimated_size):
+                    if key is not None:
+                        with self._reservation_lock:
+                            self._reservations[key] = self._reservations.get(key, 0) + estimated_size
+                    break
+            if not paused:
+                logging_utils.logging.info(f"Scheduler: admission paused (outside download window or free space below {self.min_free_space + estimated_size} bytes)")
+                paused = True
+            time.sleep(self.poll_interval)
+
+        if paused:
+            logging_utils.logging.info("Scheduler: admission resumed")
+
+    def release(self, key):
+        """
+        Give back the space reserved for `key` once its download is in the library or failed.
+        """
+        with self._reservation_lock:
+            self._reservations.pop(key, None)
+
+    def wait_for_space(self, path, required, key=None):
+        """
+        Block until the volume of `path` can take `required` more bytes.
+
+        Space reserved under `key` already belongs to this write and is not counted twice.
+        """
+        with self._reservation_lock:
+            required -= min(self._reservations.get(key, 0), required)
+
+        paused = False
+        while not self.has_space(required, paths=[path]):
+            if not paused:
+                logging_utils.logging.info(f"Scheduler: waiting for {required} free bytes at {path}")
+                paused = True
+            time.sleep(self.poll_interval)
+
+    def throttle(self, amount):
+        """
+        Account `amount` transferred bytes against the global bandwidth limit.
+        """
+        if self.bucket is not None:
+            self.bucket.consume(amount)
+
+    def progress_hook(self, d):
+        """
+        yt-dlp progress hook that applies the global bandwidth limit to running downloads.
+        """
+        if self.bucket is None: return
+
+        # yt-dlp reports cumulative bytes of the whole file, throttle on the growth per file
+        filename = d.get('filename', '')
+        with self._progress_lock:
+            if d.get('status') != 'downloading':
+                self._progress.pop(filename, None)
+                return
+
+            downloaded = d.get('downloaded_bytes') or 0
+            delta = downloaded - self._progress.get(filename, 0)
+            if delta > 0:
+                self._progress[filename] = downloaded
+
+        if delta > 0:
+            self.throttle(delta)
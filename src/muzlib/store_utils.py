@@ -0,0 +1,116 @@
+import os
+import shutil
+import threading
+
+import mutagen
+
+from . import verify_utils
+
+
+# ioctl request of Linux that clones a file (copy-on-write) on Btrfs, XFS and similar file systems
+_FICLONE = 0x40049409
+
+
+def clone_file(source_path, target_path):
+    """
+    Copy a file, as a reflink (copy-on-write clone) where the file system supports it.
+
+    A reflink shares the data blocks like a hardlink but the copies can be changed independently,
+    e.g. tagged differently by each library.
+    """
+    try:
+        import fcntl
+        with open(source_path, "rb") as source, open(target_path, "wb") as target:
+            fcntl.ioctl(target.fileno(), _FICLONE, source.fileno())
+        return
+    except (ImportError, OSError):
+        pass
+
+    shutil.copyfile(source_path, target_path)
+
+
+class ContentStore():
+    def __init__(self, store_path):
+        """
+        Audio store shared by several libraries, keyed by (ytm_id, codec).
+
+        The store holds converted but untagged audio. A library that needs a track the store
+        already has clones it and writes its own tags instead of downloading it again.
+
+        :param store_path: directory of the store, ideally on the same volume as the libraries
+        """
+        self.store_path = store_path
+        os.makedirs(self.store_path, exist_ok=True)
+
+    def path(self, ytm_id, codec):
+        # Subdirectories by id prefix keep directories small in large stores
+        return os.path.join(self.store_path, codec, ytm_id[:2], f"{ytm_id}.{codec}")
+
+    def has(self, ytm_id, codec):
+        return os.path.isfile(self.path(ytm_id, codec))
+
+    def add(self, source_path, ytm_id, codec, strip_tags=False):
+        """
+        Put a copy of an audio file into the store, unless the track is already there.
+
+        Args:
+            source_path (str): Converted audio file.
+            ytm_id (str): YouTube Music id of the track.
+            codec (str): Codec of the file (opus, mp3, ...).
+            strip_tags (bool): Remove tags from the stored copy (files taken from a library).
+
+        Returns:
+            bool: True if the file was added, False if the store already had the track.
+        """
+        store_path = self.path(ytm_id, codec)
+        if os.path.exists(store_path): return False
+
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        tmp_path = f"{store_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            clone_file(source_path, tmp_path)
+            if strip_tags:
+                audio = mutagen.File(tmp_path)
+                if audio is not None: audio.delete()
+
+            # Creating the entry with a hardlink is atomic, another library may add the same track right now
+            try:
+                os.link(tmp_path, store_path)
+            except FileExistsError:
+                return False
+            except OSError:
+                if os.path.exists(store_path): return False
+                os.replace(tmp_path, store_path)
+        finally:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+        return True
+
+    def materialize(self, ytm_id, codec, target_path, expected_duration=None):
+        """
+        Copy a track from the store to `target_path` (reflink where possible).
+
+        A stored file that fails the integrity check is removed, so the track is downloaded again.
+
+        Returns:
+            bool: True if `target_path` was written, False if the store has no usable copy.
+        """
+        store_path = self.path(ytm_id, codec)
+        if not os.path.isfile(store_path): return False
+
+        if verify_utils.check_audio(store_path, expected_duration):
+            try:
+                os.remove(store_path)
+            except FileNotFoundError:
+                pass
+            return False
+
+        tmp_path = f"{target_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            clone_file(store_path, tmp_path)
+            os.replace(tmp_path, target_path)
+        except FileNotFoundError:
+            # Removed by another library in the meantime
+            return False
+        finally:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+        return True
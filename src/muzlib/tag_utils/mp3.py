@@ -35,6 +35,9 @@ def add_tag(audio_path, track_info):
 
     if track_info['ytm_title']:
         audio["TXXX:ytm_title"] = TXXX(encoding=3, desc="ytm_title", text=track_info['ytm_title'])
+
+    if track_info.get('duration'):
+        audio["TXXX:ytm_duration"] = TXXX(encoding=3, desc="ytm_duration", text=str(track_info['duration']))
     
     audio['TIT2'] = TIT2(encoding=3, text=track_info['track_name'])  # Track Name
     audio['TPE1'] = TPE1(encoding=3, text=track_info['track_artists'])  # Track Artists
@@ -53,7 +56,7 @@ def add_tag(audio_path, track_info):
     if track_info['cover']:
         audio['APIC'] = APIC(
                 encoding=3,  # UTF-8 encoding
-                mime='image/jpeg',  # MIME type
+                mime=track_info.get('cover_mime') or 'image/jpeg',  # MIME type
                 type=3,  # Cover (front)
                 desc='cover',
                 data=base64.b64decode(track_info['cover']),  # Image data
@@ -63,7 +66,7 @@ def add_tag(audio_path, track_info):
     audio.save()
 
 
-def get_tag(audio_path):
+def get_tag(audio_path, include_cover=True):
     # Load the MP3 file
     audio = MP3(audio_path, ID3=ID3)
 
@@ -72,6 +75,7 @@ def get_tag(audio_path):
     # Fetch info from tag
     track_info['ytm_id'] = audio["TXXX:ytm_id"].text[0] if 'TXXX:ytm_id' in audio else '' # YTM id
     track_info['ytm_title'] = audio['TXXX:ytm_title'].text[0] if 'TXXX:ytm_title' in audio else ''
+    track_info['duration'] = audio['TXXX:ytm_duration'].text[0] if 'TXXX:ytm_duration' in audio else ''
     track_info['track_name'] = audio['TIT2'].text[0] if 'TIT2' in audio else '' # Track Name
     track_info['track_artists'] = audio['TPE1'].text if 'TPE1' in audio else '' # Track Artists
     track_info['track_artists_str'] = ", ".join(track_info['track_artists']) # Track Artists str
@@ -81,6 +85,7 @@ def get_tag(audio_path):
     track_info['track_number'] = audio['TRCK'][0].split('/')[0] if 'TRCK' in audio else '' # Track Number
     track_info['total_tracks'] = audio['TRCK'][0].split('/')[-1] if 'TRCK' in audio else '' # Total Tracks
     track_info['lyrics'] = audio['USLT::XXX'].text if 'USLT::XXX' in audio else '' # Lyrics
-    track_info['cover'] = base64.b64encode(audio['APIC:cover'].data).decode('utf-8') if 'APIC:cover' in audio else ''
+    track_info['cover'] = base64.b64encode(audio['APIC:cover'].data).decode('utf-8') if include_cover and 'APIC:cover' in audio else ''
+    track_info['cover_mime'] = audio['APIC:cover'].mime if 'APIC:cover' in audio else ''
     
     return track_info
\ No newline at end of file
@@ -35,6 +35,9 @@ def add_tag(audio_path, track_info):
     if track_info.get('ytm_title'):
         audio['ytm_title'] = str(track_info['ytm_title'])
 
+    if track_info.get('duration'):
+        audio['ytm_duration'] = str(track_info['duration'])
+
     # Standard Metadata
     if track_info.get('track_name'):
         audio['title'] = track_info['track_name']
@@ -72,11 +75,11 @@ def add_tag(audio_path, track_info):
             # The input 'cover' is expected to be a base64 string of the image bytes
             picture.data = base64.b64decode(track_info['cover'])
             picture.type = 3  # Cover (front)
-            picture.mime = "image/jpeg"
+            picture.mime = track_info.get('cover_mime') or "image/jpeg"
             picture.desc = "cover"
-            picture.width = 0
-            picture.height = 0
-            picture.depth = 0
+            picture.width = track_info.get('cover_width') or 0
+            picture.height = track_info.get('cover_height') or 0
+            picture.depth = 24 if picture.width else 0
 
             # Encode the picture structure to base64 for the Vorbis comment
             picture_data = picture.write()
@@ -90,7 +93,7 @@ def add_tag(audio_path, track_info):
     audio.save()
 
 
-def get_tag(audio_path):
+def get_tag(audio_path, include_cover=True):
     """
     Reads Vorbis Comment tags from an Opus file.
     """
@@ -110,6 +113,7 @@ def get_tag(audio_path):
     # Fetch info
     track_info['ytm_id'] = get_first('ytm_id')
     track_info['ytm_title'] = get_first('ytm_title')
+    track_info['duration'] = get_first('ytm_duration')
 
     track_info['track_name'] = get_first('title')
 
@@ -133,12 +137,18 @@ def get_tag(audio_path):
     # Fetch Cover Art
     # We must reverse the FLAC picture encoding logic
     track_info['cover'] = ''
-    if 'metadata_block_picture' in tags:
+    track_info['cover_mime'] = ''
+    track_info['cover_width'] = 0
+    track_info['cover_height'] = 0
+    if include_cover and 'metadata_block_picture' in tags:
         try:
             b64_data = tags['metadata_block_picture'][0]
             picture = Picture(base64.b64decode(b64_data))
             # Return the base64 string of the raw image bytes (matching the MP3 util output)
             track_info['cover'] = base64.b64encode(picture.data).decode('utf-8')
+            track_info['cover_mime'] = picture.mime
+            track_info['cover_width'] = picture.width
+            track_info['cover_height'] = picture.height
         except Exception:
             pass
 
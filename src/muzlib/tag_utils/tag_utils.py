@@ -31,11 +31,17 @@ def add_tag(audio_path, track_info):
         from . import opus
         opus.add_tag(audio_path, track_info)
 
-def get_tag(audio_path):
+def get_tag(audio_path, include_cover=True):
+    """
+    Reads the tags of an MP3 or Opus file.
 
+    Args:
+        audio_path (str): Path to the audio file.
+        include_cover (bool): Also decode the cover art. Skipping it makes scans of large libraries much cheaper.
+    """
     if audio_path.endswith('.mp3'):
         from . import mp3
-        return mp3.get_tag(audio_path)
+        return mp3.get_tag(audio_path, include_cover=include_cover)
     if audio_path.endswith('.opus'):
         from . import opus
-        return opus.get_tag(audio_path)
+        return opus.get_tag(audio_path, include_cover=include_cover)
@@ -0,0 +1,151 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field, fields
+
+
+class CoverCache():
+    def __init__(self, max_items=64):
+        """
+        Bounded, thread-safe store of base64 encoded covers (with mime type and dimensions)
+        referenced by their hash.
+
+        Tracks of one album share a single cover string instead of each holding a copy.
+        Covers pinned by tracks that are still in flight are never dropped, the cache may
+        exceed `max_items` while more covers than that are pinned.
+
+        :param max_items: number of covers kept, the least recently used unpinned ones are dropped first
+        """
+        self.max_items = max_items
+        self._covers = OrderedDict()
+        self._pins = {}
+        self._lock = threading.Lock()
+
+    def _evict(self):
+        # Drop the least recently used unpinned covers, called with the lock held
+        for cover_hash in list(self._covers):
+            if len(self._covers) <= self.max_items: return
+            if cover_hash not in self._pins:
+                del self._covers[cover_hash]
+
+    def put(self, cover, mime='image/jpeg', width=0, height=0, pin=False):
+        """
+        Store a base64 encoded cover and return its hash ('' for no cover).
+
+        With `pin` the cover is also pinned (see `pin()`).
+        """
+        if not cover: return ''
+
+        cover_hash = hashlib.sha1(cover.encode('ascii')).hexdigest()
+        with self._lock:
+            self._covers[cover_hash] = (cover, mime or 'image/jpeg', width or 0, height or 0)
+            self._covers.move_to_end(cover_hash)
+            if pin:
+                self._pins[cover_hash] = self._pins.get(cover_hash, 0) + 1
+            self._evict()
+        return cover_hash
+
+    def pin(self, cover_hash):
+        """
+        Keep a cover until a matching `unpin()`, pins are counted.
+
+        Returns:
+            bool: False if the cover is not in the cache (anymore).
+        """
+        with self._lock:
+            if cover_hash not in self._covers: return False
+            self._pins[cover_hash] = self._pins.get(cover_hash, 0) + 1
+            self._covers.move_to_end(cover_hash)
+        return True
+
+    def unpin(self, cover_hash):
+        with self._lock:
+            pins = self._pins.get(cover_hash, 0) - 1
+            if pins > 0:
+                self._pins[cover_hash] = pins
+            else:
+                self._pins.pop(cover_hash, None)
+            self._evict()
+
+    def get(self, cover_hash):
+        """
+        Return the base64 encoded cover for `cover_hash` ('' if unknown or evicted).
+        """
+        return self.get_entry(cover_hash)[0]
+
+    def get_entry(self, cover_hash):
+        """
+        Return (cover, mime, width, height) for `cover_hash`, with an empty cover if it is unknown.
+        """
+        with self._lock:
+            entry = self._covers.get(cover_hash)
+            if entry is None: return '', 'image/jpeg', 0, 0
+            self._covers.move_to_end(cover_hash)
+        return entry
+
+
+@dataclass(slots=True)
+class TrackInfo:
+    """
+    Metadata of one track. The cover is referenced by hash in a `CoverCache`.
+    """
+    ytm_id: str = ""
+    ytm_title: str = ""
+    track_name: str = ""
+    track_artists: list = field(default_factory=list)
+    track_artists_str: str = ""
+    release_date: str = ""
+    album_name: str = ""
+    album_artists: list = field(default_factory=list)
+    track_number: int | str = ""
+    total_tracks: int | str = ""
+    duration: int | str = ""  # Length reported by YouTube Music in seconds
+    lyrics: str = ""
+    cover_hash: str = ""
+    path: str = ""  # Path inside the library without extension (restored tracks only)
+
+    @classmethod
+    def from_dict(cls, track_info, covers):
+        """
+        Build a `TrackInfo` from a track dictionary (tags, backups, failure journal).
+
+        The cover stays pinned in `covers` until `release()`.
+
+        Args:
+            track_info (dict): Track dictionary, unknown keys are ignored.
+            covers (CoverCache): Cache that receives the `cover` of the dictionary.
+        """
+        names = {f.name for f in fields(cls)} - {'cover_hash'}
+        info = cls(**{key: value for key, value in track_info.items() if key in names and value is not None})
+        info.cover_hash = covers.put(
+            track_info.get('cover', ''),
+            track_info.get('cover_mime', 'image/jpeg'),
+            track_info.get('cover_width', 0),
+            track_info.get('cover_height', 0),
+            pin=True,
+        )
+        return info
+
+    def to_dict(self, covers):
+        """
+        Convert to the track dictionary expected by `tag_utils`, resolving the cover from `covers`.
+        """
+        track_info = {f.name: getattr(self, f.name) for f in fields(self) if f.name not in ('cover_hash', 'path')}
+        cover, mime, width, height = covers.get_entry(self.cover_hash)
+        track_info['cover'] = cover
+        track_info['cover_mime'] = mime
+        track_info['cover_width'] = width
+        track_info['cover_height'] = height
+        if self.path:
+            track_info['path'] = self.path
+        return track_info
+
+    def release(self, covers):
+        """
+        Drop heavy fields once the track has been tagged, they are stored in the file itself,
+        and unpin its cover in `covers`.
+        """
+        if self.cover_hash:
+            covers.unpin(self.cover_hash)
+        self.lyrics = ""
+        self.cover_hash = ""
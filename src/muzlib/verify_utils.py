@@ -0,0 +1,108 @@
+import hashlib
+
+import mutagen
+
+
+REQUIRED_TAGS = ('ytm_id', 'track_name', 'track_artists')
+
+
+def file_checksum(audio_path, chunk_size=1024 * 1024):
+    """
+    SHA-256 of a file, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(audio_path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _duration_tolerance(expected):
+    # YTM reports whole seconds, encoders add or drop a few frames
+    return max(2.0, 0.02 * expected)
+
+
+def check_audio(audio_path, expected_duration=None):
+    """
+    Check that an audio file is complete.
+
+    Args:
+        audio_path (str): Path to the audio file.
+        expected_duration (int | str, optional): Length reported by YouTube Music in seconds.
+
+    Returns:
+        list[str]: Problems found, empty if the file is fine.
+    """
+    try:
+        audio = mutagen.File(audio_path)
+    except Exception as e:
+        return [f"unreadable container: {e}"]
+    if audio is None or audio.info is None:
+        return ["unreadable container: unknown format"]
+
+    length = getattr(audio.info, 'length', 0) or 0
+    if length <= 0:
+        return ["no audio"]
+
+    try:
+        expected_duration = float(expected_duration) if expected_duration else 0
+    except ValueError:
+        expected_duration = 0
+
+    if expected_duration and abs(length - expected_duration) > _duration_tolerance(expected_duration):
+        return [f"duration {length:.1f} s, expected {expected_duration:.0f} s"]
+
+    return []
+
+
+def check_tags(track_info):
+    """
+    Returns:
+        list[str]: Problems with the tags of a track, empty if all required tags are present.
+    """
+    if not track_info:
+        return ["no tags"]
+
+    missing = [tag for tag in REQUIRED_TAGS if not track_info.get(tag)]
+    return [f"missing tags: {', '.join(missing)}"] if missing else []
+
+
+def verify_file(audio_path, expected_checksum=None, expected_duration=None, duration_lookup=None):
+    """
+    Run all checks on one library file.
+
+    Args:
+        audio_path (str): Path to the audio file.
+        expected_checksum (str, optional): Checksum from the last verification, a different
+            checksum of an unchanged file means the file got corrupted on disk.
+        expected_duration (int | str, optional): Length from the last verification, for files
+            without a duration tag.
+        duration_lookup (callable, optional): Called with the ytm_id of a file whose length is
+            not known otherwise, returns the length in seconds or '' if it can't be looked up.
+
+    Returns:
+        dict: `sha256`, `problems` (empty if the file is fine), `track_info` (tags without cover,
+            empty if they can't be read) and `duration` (length the file was checked against,
+            '' if the length couldn't be verified).
+    """
+    from .tag_utils import tag_utils
+
+    checksum = file_checksum(audio_path)
+    problems = []
+    if expected_checksum and checksum != expected_checksum:
+        problems.append("checksum changed")
+
+    try:
+        track_info = tag_utils.get_tag(audio_path, include_cover=False) or {}
+    except Exception:
+        track_info = {}
+
+    # Files downloaded before the duration tag existed don't carry their length
+    duration = track_info.get('duration') or expected_duration or ''
+    if not duration and duration_lookup is not None and track_info.get('ytm_id'):
+        duration = duration_lookup(track_info['ytm_id'])
+
+    problems += check_audio(audio_path, duration)
+    problems += check_tags(track_info)
+
+    return {'sha256': checksum, 'problems': problems, 'track_info': track_info, 'duration': duration}
@@ -0,0 +1,108 @@
+import os
+import base64
+import tempfile
+import unittest
+import tracemalloc
+from concurrent.futures import Future
+
+# Keep the test log out of the working directory
+os.environ.setdefault('MUZLIB_LOG_FILE', '-')
+os.environ.setdefault('MUZLIB_LOG_LEVEL', 'WARNING')
+
+from muzlib.muzlib import Muzlib
+from muzlib.track_utils import TrackInfo
+from muzlib.tag_utils import tag_utils
+
+
+# One MPEG-1 Layer III frame (128 kbit/s, 44.1 kHz) of silence
+_MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+_COVER_SIZE = 32 * 1024
+
+
+def _make_library(library_path, tracks):
+    # Every track gets its own cover and lyrics, like a real library
+    for number in range(tracks):
+        path = os.path.join(library_path, "Artist", f"{number}. Artist - Track {number}.mp3")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(_MP3_FRAME * 40)
+
+        tag_utils.add_tag(path, {
+            'ytm_id': f"id{number:08d}",
+            'ytm_title': f"Artist - Track {number}",
+            'track_name': f"Track {number}",
+            'track_artists': ["Artist"],
+            'release_date': "2020",
+            'album_name': "Album",
+            'album_artists': ["Artist"],
+            'track_number': number + 1,
+            'total_tracks': tracks,
+            'lyrics': f"Lyrics of track {number}\n" * 50,
+            'cover': base64.b64encode(os.urandom(_COVER_SIZE)).decode('ascii'),
+            'cover_mime': 'image/jpeg',
+        })
+
+
+def _peak_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class BackupMemoryTest(unittest.TestCase):
+    """
+    Backups and restores stream the tracks, so their peak memory must not grow with the library.
+    """
+
+    def _library(self, tracks):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        _make_library(directory.name, tracks)
+
+        ml = Muzlib(directory.name, codec="mp3", postprocess_workers=1)
+        self.addCleanup(ml.close)
+        return ml
+
+    def _stub_downloads(self, ml):
+        # Restores go through the download pipeline, only the conversion into TrackInfo is kept
+        restored = []
+
+        def submit_download(track_info):
+            track = TrackInfo.from_dict(track_info, ml.covers)
+            restored.append(track.ytm_id)
+            track.release(ml.covers)
+            result = Future()
+            result.set_result(True)
+            return result
+
+        ml._submit_download = submit_download
+        return restored
+
+    def _measure(self, tracks):
+        ml = self._library(tracks)
+
+        backup_paths = []
+        backup_peak = _peak_memory(lambda: backup_paths.append(ml.backup_library()))
+
+        restored = self._stub_downloads(ml)
+        restore_peak = _peak_memory(lambda: ml.restore_library(backup_paths[0]))
+        self.assertEqual(len(restored), tracks)
+
+        return backup_peak, restore_peak
+
+    def test_peak_memory_is_flat(self):
+        # Both libraries have more distinct covers than the bounded cover cache holds
+        small_backup, small_restore = self._measure(100)
+        large_backup, large_restore = self._measure(400)
+
+        # Holding all covers of the large library alone would take more than 15 MiB
+        slack = 512 * 1024
+        self.assertLess(large_backup, 1.5 * small_backup + slack, f"backup peak {small_backup} -> {large_backup} bytes")
+        self.assertLess(large_restore, 1.5 * small_restore + slack, f"restore peak {small_restore} -> {large_restore} bytes")
+
+
+if __name__ == "__main__":
+    unittest.main()
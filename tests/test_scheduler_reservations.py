@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('MUZLIB_LOG_FILE', '-')
+os.environ.setdefault('MUZLIB_LOG_LEVEL', 'WARNING')
+
+from muzlib import muzlib
+from muzlib.track_utils import TrackInfo
+
+
+_SOURCE_SIZE = 500
+
+
+class _FakeYoutubeDL():
+    # Resolves every track to a source of `_SOURCE_SIZE` bytes and "downloads" it into the staging directory
+    def __init__(self, staging_path):
+        self.staging_path = staging_path
+
+    def extract_info(self, url, download=False):
+        return {'id': url.rsplit('=', 1)[-1], 'filesize': _SOURCE_SIZE, 'acodec': 'opus'}
+
+    def process_ie_result(self, info, download=True):
+        path = os.path.join(self.staging_path, f"{info['id']}.source.webm")
+        with open(path, "wb") as file:
+            file.write(b'\0' * _SOURCE_SIZE)
+        return {**info, 'requested_downloads': [{'filepath': path}]}
+
+
+def _convert_and_tag(source_path, target_path, codec, source_codec, track_info, store=None):
+    shutil.move(source_path, target_path)
+    return target_path
+
+
+class ReservationTest(unittest.TestCase):
+    def test_tight_space_does_not_deadlock(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        ml = muzlib.Muzlib(directory.name, codec="opus", download_workers=1)
+        self.addCleanup(ml.close)
+        # Cleanups run in reverse order: unblock admissions first, so a regression fails instead of hanging
+        self.addCleanup(setattr, ml.scheduler, 'free_space', lambda path: 1 << 50)
+
+        # Free space for exactly one admitted download (source and converted file)
+        ml.scheduler.free_space = lambda path: 2 * _SOURCE_SIZE
+        ml.scheduler.poll_interval = 0.01
+        ydl = _FakeYoutubeDL(ml.staging_path)
+        ml._postprocess_pool = ThreadPoolExecutor(max_workers=1)
+
+        tracks = [TrackInfo(ytm_id=f"a{number:02d}", track_name=f"Track {number}", track_artists=["Artist"], track_artists_str="Artist") for number in range(3)]
+        with mock.patch.object(muzlib.Muzlib, 'ydl', property(lambda self: ydl)), \
+             mock.patch.object(muzlib.postprocess_utils, 'convert_and_tag', _convert_and_tag):
+            results = [ml._submit_download(track) for track in tracks]
+            self.assertTrue(all(result.result(timeout=10) for result in results))
+
+        self.assertEqual(ml.scheduler.reserved, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()